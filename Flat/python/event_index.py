@@ -0,0 +1,351 @@
+'''PandaAnalysis.Flat.event_index
+
+Evaluates selections (compiled, over GeneralTree) and cuts (TTreeFormula strings,
+as in sel.cuts[region]) over whole flat trees once, and keeps the result in a
+sidecar file next to the flat file, <file>.idx.npz, so that later scans can
+reuse it. The sidecar is thrown away when the flat file changes.
+'''
+
+import numpy as np
+import ROOT as root
+import hashlib
+import tempfile
+import atexit
+from os import path, rename, getpid, close, remove
+from re import compile as rcompile
+from zipfile import BadZipfile
+from PandaCore.Utils.logging import logger
+
+treename = 'events' # input tree name
+batch_size = 100000 # entries evaluated per call into C++
+
+_member_re = rcompile(r'gt->(\w+)')
+_name_re = rcompile(r'[A-Za-z_]\w*')
+_helpers = False
+_cut_helpers = False
+
+
+def _normalize(cut):
+    return ' '.join(cut.split())
+
+
+def _key(kind, expr):
+    return kind + '_' + hashlib.md5(expr).hexdigest()
+
+
+def sidecar(fpath):
+    return path.splitext(fpath)[0] + '.idx.npz'
+
+
+class Index:
+    def __init__(self, fpath):
+        '''
+        What is known about one flat file
+
+        Arguments:
+            fpath {str} -- path of the flat file
+        '''
+        self.fpath = fpath
+        self.mtime = path.getmtime(fpath)
+        self.n_entries = None
+        self.arrays = {}
+        self.__changed = False
+        try:
+            stored = np.load(sidecar(fpath))
+            if float(stored['mtime']) == self.mtime:
+                self.n_entries = int(stored['n_entries'])
+                self.arrays = {k : stored[k] for k in stored.files
+                               if k not in ('mtime', 'n_entries')}
+        except (IOError, KeyError, ValueError, BadZipfile): # no index yet, or a broken one
+            pass
+    def mask(self, expr):
+        '''
+        Returns:
+            boolean array over all entries, or None if expr has not been evaluated
+        '''
+        packed = self.arrays.get(_key('sel', expr))
+        if packed is None:
+            return None
+        return np.unpackbits(packed)[:self.n_entries].astype(bool)
+    def set_mask(self, expr, mask):
+        self.n_entries = mask.shape[0]
+        self.arrays[_key('sel', expr)] = np.packbits(mask.astype(np.uint8))
+        self.__changed = True
+    def entries(self, cut):
+        '''
+        Returns:
+            sorted indices of the entries passing cut, or None if cut has not been evaluated
+        '''
+        return self.arrays.get(_key('cut', cut))
+    def set_entries(self, cut, entries, n_entries):
+        self.n_entries = n_entries
+        self.arrays[_key('cut', cut)] = entries.astype(np.int64)
+        self.__changed = True
+    def save(self):
+        if not self.__changed:
+            return
+        tmp_path = '%s.%i.tmp.npz'%(sidecar(self.fpath)[:-len('.npz')], getpid())
+        try:
+            np.savez_compressed(tmp_path, mtime=self.mtime, n_entries=self.n_entries, **self.arrays)
+            rename(tmp_path, sidecar(self.fpath))
+        except (IOError, OSError) as e:
+            logger.warning('event_index.Index.save', 'Could not write %s: %s'%(sidecar(self.fpath), str(e)))
+        self.__changed = False
+
+
+def _load_helpers():
+    global _helpers
+    if _helpers:
+        return
+    import PandaAnalysis.Flat.selection as selection # loads PandaAnalyzer and GeneralTree
+    root.gInterpreter.Declare('''
+    namespace panda_index {
+      typedef std::function<bool(const GeneralTree*)> accept_func;
+      // point the branches of in at the members of gt that WriteTree books.
+      // returns the used members that could not be bound: those that are not
+      // booked as branches (e.g. maps like sf_btags, or methods) would only
+      // ever hold their default values
+      std::vector<std::string> bind(GeneralTree& gt, TTree* in, const std::vector<std::string>& used) {
+        std::vector<std::string> missing;
+        TTree scratch("panda_index_scratch", "");
+        scratch.SetDirectory(0);
+        gt.WriteTree(&scratch);
+        in->SetBranchStatus("*", 0);
+        for (auto& name : used) {
+          TBranch* b = scratch.GetBranch(name.c_str());
+          if (b == nullptr) {
+            missing.push_back(name);
+            continue;
+          }
+          if (in->GetBranch(name.c_str()) == nullptr) {
+            missing.push_back(name);
+            continue;
+          }
+          in->SetBranchStatus(name.c_str(), 1);
+          if (in->SetBranchAddress(name.c_str(), b->GetAddress()) < 0)
+            missing.push_back(name);
+        }
+        gt.treePtr = nullptr;
+        return missing;
+      }
+      // out[j*(stop-start) + i-start] = fs[j](entry i)
+      void eval(TTree* in, const GeneralTree& gt, const std::vector<accept_func>& fs,
+                Long64_t start, Long64_t stop, unsigned char* out) {
+        Long64_t n = stop - start;
+        for (Long64_t i = start; i < stop; ++i) {
+          in->GetEntry(i);
+          for (unsigned j = 0; j != fs.size(); ++j)
+            out[j * n + (i - start)] = fs[j](&gt);
+        }
+      }
+    }
+    ''')
+    _helpers = True
+
+
+def _compute(fpath, exprs):
+    import PandaAnalysis.Flat.selection as selection
+    _load_helpers()
+    f = root.TFile.Open(fpath)
+    tree = f.Get(treename)
+    gt = root.GeneralTree()
+    used = root.std.vector('std::string')()
+    for name in sorted(set(_member_re.findall(' '.join(exprs)))):
+        used.push_back(name)
+    missing = list(root.panda_index.bind(gt, tree, used))
+    if missing:
+        f.Close()
+        raise ValueError('%s cannot be evaluated on %s, no branch for: gt->%s'%(
+                         ', '.join(exprs), fpath, ', gt->'.join(missing)))
+    fs = root.std.vector('panda_index::accept_func')()
+    for fn in selection.define(*exprs):
+        fs.push_back(fn)
+
+    n_entries = tree.GetEntries()
+    masks = np.zeros((len(exprs), n_entries), dtype=np.uint8)
+    for start in xrange(0, n_entries, batch_size):
+        stop = min(n_entries, start + batch_size)
+        out = np.zeros(len(exprs) * (stop - start), dtype=np.uint8)
+        root.panda_index.eval(tree, gt, fs, start, stop, out)
+        masks[:, start:stop] = out.reshape(len(exprs), stop - start)
+    f.Close()
+    return masks.astype(bool)
+
+
+def evaluate(fpath, selections):
+    '''
+    Arguments:
+        fpath {str} -- flat file, in the GeneralTree layout
+        selections {list} -- C++ expressions of gt, as passed to selection.build,
+                             or the names they were built under
+    Returns:
+        list of boolean arrays over the entries of the file, one per selection
+    '''
+    import PandaAnalysis.Flat.selection as selection
+    exprs = [selection.expressions.get(x, selection.normalize(x)) for x in selections]
+    index = Index(fpath)
+    todo = sorted(set([x for x in exprs if index.mask(x) is None]))
+    if todo:
+        logger.info('event_index.evaluate', 'Evaluating %i selections on %s'%(len(todo), fpath))
+        for expr, mask in zip(todo, _compute(fpath, todo)):
+            index.set_mask(expr, mask)
+        index.save()
+    return [index.mask(x) for x in exprs]
+
+
+def entries(fpath, selection_):
+    '''
+    Returns:
+        indices of the entries of fpath that pass one selection
+    '''
+    return np.flatnonzero(evaluate(fpath, [selection_])[0])
+
+
+def _load_cut_helpers():
+    global _cut_helpers
+    if _cut_helpers:
+        return
+    root.gInterpreter.Declare('''
+    #include "TTreeFormula.h"
+    #include "TEntryList.h"
+    namespace panda_index {
+      // one pass over in for all cuts, out[j*n + i] = cut j passes entry i.
+      // as for TTree::Draw, an entry passes if any instance of the formula does.
+      // returns the index of a cut that does not compile, or -1
+      int eval_cuts(TTree* in, const std::vector<std::string>& cuts, unsigned char* out) {
+        Long64_t n = in->GetEntries();
+        std::vector<TTreeFormula*> fs;
+        int bad = -1;
+        for (unsigned j = 0; j != cuts.size(); ++j) {
+          fs.push_back(new TTreeFormula(Form("panda_cut_%u", j), cuts[j].c_str(), in));
+          if (fs.back()->GetNdim() == 0 && bad < 0)
+            bad = j;
+        }
+        for (Long64_t i = 0; bad < 0 && i < n; ++i) {
+          in->LoadTree(i);
+          for (unsigned j = 0; j != fs.size(); ++j) {
+            bool pass = false;
+            int ndata = fs[j]->GetNdata();
+            for (int k = 0; k < ndata && !pass; ++k)
+              pass = fs[j]->EvalInstance(k) != 0;
+            out[j * n + i] = pass;
+          }
+        }
+        for (auto f : fs)
+          delete f;
+        return bad;
+      }
+      TEntryList* make_list(TTree* in, const Long64_t* entries, Long64_t n) {
+        TEntryList* l = new TEntryList("panda_entries", "", in);
+        for (Long64_t i = 0; i != n; ++i)
+          l->Enter(entries[i], in);
+        return l;
+      }
+    }
+    ''')
+    _cut_helpers = True
+
+
+def cut_entries(fpath, cuts):
+    '''
+    Arguments:
+        fpath {str} -- flat file
+        cuts {list} -- TTreeFormula cut strings, e.g. sel.cuts[region]
+    Returns:
+        list of sorted arrays of the entries passing each cut
+    '''
+    cuts = [_normalize(x) for x in cuts]
+    index = Index(fpath)
+    todo = sorted(set([x for x in cuts if index.entries(x) is None]))
+    if todo:
+        logger.info('event_index.cut_entries', 'Evaluating %i cuts on %s'%(len(todo), fpath))
+        _load_cut_helpers()
+        f = root.TFile.Open(fpath)
+        tree = f.Get(treename)
+        n_entries = tree.GetEntries()
+        vcuts = root.std.vector('std::string')()
+        for x in todo:
+            vcuts.push_back(x)
+        out = np.zeros(len(todo) * n_entries, dtype=np.uint8)
+        bad = root.panda_index.eval_cuts(tree, vcuts, out)
+        f.Close()
+        if bad >= 0:
+            raise ValueError('Could not compile cut on %s: %s'%(fpath, todo[bad]))
+        for x, passed in zip(todo, out.reshape(len(todo), n_entries)):
+            index.set_entries(x, np.flatnonzero(passed), n_entries)
+        index.save()
+    return [index.entries(x) for x in cuts]
+
+
+def reduced_tree(fpath, cuts, formulas=None, out_path=None):
+    '''
+    Copy the entries of fpath passing any of cuts into another file, keeping only
+    the branches that cuts and formulas use (all of them if formulas is None).
+    The cuts still have to be applied when reading it, but only over the few 
+    entries that are left
+
+    Arguments:
+        fpath {str} -- flat file
+        cuts {list} -- TTreeFormula cut strings
+        formulas {list} -- other expressions that will be read from the tree
+        out_path {str} -- where to write the copy, a temporary file if None
+    Returns:
+        (TTree, cleanup), call cleanup() once the tree is no longer needed. 
+        it only removes the copy if it is a temporary file
+    '''
+    entries = reduce(np.union1d, cut_entries(fpath, cuts))
+    _load_cut_helpers()
+    f_in = root.TFile.Open(fpath)
+    tree = f_in.Get(treename)
+    n_entries = tree.GetEntries()
+    if formulas is not None:
+        names = set(_name_re.findall(' '.join(list(cuts) + list(formulas))))
+        tree.SetBranchStatus('*', 0)
+        for b in tree.GetListOfBranches():
+            if b.GetName() in names:
+                tree.SetBranchStatus(b.GetName(), 1)
+    entries = np.ascontiguousarray(entries, dtype=np.int64)
+    tree.SetEntryList(root.panda_index.make_list(tree, entries, len(entries)))
+    temporary = out_path is None
+    if temporary:
+        fd, out_path = tempfile.mkstemp(suffix='.root', prefix='panda_index_')
+        close(fd)
+    f_out = root.TFile.Open(out_path, 'RECREATE')
+    reduced = tree.CopyTree('')
+    reduced.Write(treename)
+    f_in.Close()
+    logger.info('event_index.reduced_tree', 
+                'Reading %i/%i entries of %s'%(len(entries), n_entries, fpath))
+    def cleanup():
+        f_out.Close()
+        if temporary:
+            remove(out_path)
+    return reduced, cleanup
+
+
+def indexed_file(fpath, cuts, formulas=None):
+    '''
+    For callers that take file paths, e.g. PlotUtility Process.add_file:
+    the entries of fpath passing any of cuts, in a file that is removed at exit
+
+    Returns:
+        path of the reduced file
+    '''
+    fd, out_path = tempfile.mkstemp(suffix='.root', prefix='panda_index_')
+    close(fd)
+    _, cleanup = reduced_tree(fpath, cuts, formulas, out_path)
+    cleanup()
+    atexit.register(lambda : path.isfile(out_path) and remove(out_path))
+    return out_path
+
+
+def read_tree(selector, fpath, branches, cut):
+    '''
+    Selector.read_tree over the entries of fpath that pass cut, only
+    '''
+    tree, cleanup = reduced_tree(fpath, [cut], branches)
+    try:
+        selector.read_tree(tree, branches = branches, cut = cut)
+    finally:
+        cleanup()
+    return selector
@@ -4,19 +4,242 @@ Converts large flat trees into smaller trees used for fitting
 ''' 
 
 import PandaCore.Tools.root_interface as root_interface 
+import PandaAnalysis.Flat.event_index as event_index
 from PandaCore.Tools.Misc import tAND 
 from PandaCore.Utils.logging import logger
 import numpy as np 
+import root_numpy as rnp
 import ROOT as root 
+import multiprocessing as mp
+from os import path, remove, system
 from itertools import chain 
+from copy import copy
 
 _trees = {} # used to prevent gc and multiple openings of a file
 _files = {}
+_reads = {} # id of input tree -> _SharedRead
+_groups = [] # work units of run_regions, set before the workers fork
+memory_budget = None # MB; if set, inputs are streamed in chunks of about this size by default
+use_index = False # only read the entries passing the cuts, from the event_index sidecars of the inputs
 
 treename = 'events' # input tree name
 
+# how systematic weights are written out:
+#  'trees'   : one full tree per shift, <process>_<shift>, holding the variables and 'weight'
+#  'columns' : a single tree per process, with 'weight' and one 'weight_<shift>' per shift
+#  'friends' : <process> holds the variables and 'weight', <process>_<shift> only 'weight',
+#              entry-aligned so that it can be attached with TTree::AddFriend
+layouts = ('trees', 'columns', 'friends')
+
+
+def input_files(tree):
+    '''
+    Arguments:
+        tree {ROOT.TTree} -- TTree or TChain
+    Returns:
+        list of paths of the files the tree reads
+    '''
+    if hasattr(tree, 'GetListOfFiles'):
+        return [f.GetTitle() for f in tree.GetListOfFiles()]
+    f = tree.GetCurrentFile()
+    return [f.GetName()] if f else []
+
+
+def _as_array(xarr, columns):
+    '''
+    Arguments:
+        xarr {np.ndarray} -- structured array, with fields named by formula
+        columns {list} -- (output branch name, input formula)
+    Returns:
+        structured array with the output branch names
+    '''
+    arr = np.empty(xarr.shape[0], dtype=[(name, xarr.dtype[formula]) for name, formula in columns])
+    for name, formula in columns:
+        arr[name] = xarr[formula]
+    return arr
+
+
+def _plan(procs):
+    '''
+    Returns:
+        the formulas to read for procs, the cut to read them under, and whether 
+        each proc has to mask out the events of the others
+    '''
+    cuts = sorted(set([p.cut for p in procs]))
+    formulas = set(chain.from_iterable([p.all_branches.values() for p in procs]))
+    if len(cuts) == 1:
+        return sorted(formulas), cuts[0], False
+    formulas.update(cuts)
+    return sorted(formulas), ' || '.join(['(%s)'%c for c in cuts]), True
+
+
+class _Output:
+    def __init__(self, proc, f_out, layout):
+        '''
+        The output trees of a process, filled one chunk at a time
+
+        Arguments:
+            proc {Process} -- process being written
+            f_out {ROOT.TFile} -- output file
+            layout {str} -- one of layouts
+        '''
+        self.proc = proc
+        self.f_out = f_out
+        self.tables = proc.tables(layout)
+        self.trees = {}
+    def fill(self, xarr):
+        for postfix, columns in self.tables:
+            arr = _as_array(xarr, columns)
+            if postfix in self.trees:
+                rnp.array2tree(arr, tree = self.trees[postfix])
+            else:
+                self.f_out.cd()
+                self.trees[postfix] = rnp.array2tree(arr, name = self.proc.name+postfix)
+    def close(self):
+        self.f_out.cd()
+        for postfix, _ in self.tables:
+            self.trees[postfix].Write(self.proc.name+postfix, root.TObject.kOverwrite)
+    def discard(self):
+        # drop what has been filled so far, in memory and any autosaved cycles
+        for postfix, _ in self.tables:
+            self.f_out.Delete(self.proc.name+postfix+';*')
+        self.trees = {}
+
+
+class _SharedRead:
+    def __init__(self, tree):
+        '''
+        Reads a tree once for all the processes that use it: the union of their 
+        formulas and their cuts are evaluated in a single pass over the events 
+        passing any of the cuts, and each process then selects its events by mask
+
+        Arguments:
+            tree {ROOT.TTree} -- input TTree
+        '''
+        self.tree = tree
+        self.processes = []
+        self.__xarr = None
+        self.__masked = False
+        self.__separate = False
+        self.__pending = 0
+    def add(self, proc):
+        self.processes.append(proc)
+        self.__pending += 1
+    def __done(self, n=1):
+        # the last process to use the tree releases it
+        self.__pending -= n
+        if self.__pending <= 0:
+            self.__xarr = None
+            _reads.pop(id(self.tree), None)
+    def __source(self, procs, formulas):
+        '''
+        Returns:
+            the tree to read procs from, and what to call when done with it
+        '''
+        files = procs[0].files
+        if not use_index or len(files) != 1 or self.tree.GetName() != event_index.treename \
+           or hasattr(self.tree, 'GetListOfFiles'):
+            return self.tree, lambda : None
+        try:
+            return event_index.reduced_tree(files[0], [p.cut for p in procs], formulas)
+        except ValueError as e:
+            logger.warning('fitting_forest._SharedRead', 
+                           'Not using the index of %s: %s'%(files[0], str(e)))
+            return self.tree, lambda : None
+    def __read(self):
+        formulas, cut, masked = _plan(self.processes)
+        logger.info('fitting_forest._SharedRead',
+                    'Reading %i formulas for %i processes'%(len(formulas), len(self.processes)))
+        tree, cleanup = self.__source(self.processes, formulas)
+        try:
+            self.__xarr = root_interface.read_tree(tree = tree,
+                                                   branches = formulas,
+                                                   cut = cut)
+        except ValueError as e:
+            if len(self.processes) == 1:
+                raise
+            # e.g. MC formulas that data does not have, let each process fail on its own
+            logger.warning('fitting_forest._SharedRead', 
+                           'Shared read failed (%s), reading each process separately'%str(e))
+            self.__separate = True
+            return
+        finally:
+            cleanup()
+        self.__masked = masked
+    def get(self, proc):
+        '''
+        Returns:
+            the events of proc, as a structured array with fields named by formula
+        '''
+        try:
+            if self.__xarr is None and not self.__separate:
+                self.__read()
+            if self.__separate:
+                return root_interface.read_tree(tree = self.tree, 
+                                                branches = sorted(set(proc.all_branches.values())),
+                                                cut = proc.cut)
+            xarr = self.__xarr
+            if self.__masked:
+                xarr = xarr[xarr[proc.cut] != 0]
+            return xarr
+        finally:
+            self.__done()
+    def stream(self, targets, layout, max_memory):
+        '''
+        Write processes of this tree chunk by chunk, in one pass over the tree
+
+        Arguments:
+            targets {list} -- (Process, output ROOT.TFile)
+            layout {str} -- one of layouts
+            max_memory {float} -- budget for the arrays of one chunk, in MB
+        '''
+        procs = [p for p, _ in targets]
+        formulas, cut, masked = _plan(procs)
+        # a chunk is held about three times: as read, masked, and as output columns
+        chunk = max(1, int(max_memory * 1e6 / (3 * 8 * len(formulas))))
+        tree, cleanup = self.__source(procs, formulas)
+        n_entries = tree.GetEntries()
+        logger.info('fitting_forest._SharedRead.stream',
+                    'Reading %i formulas for %i processes in chunks of %i entries'%(
+                        len(formulas), len(procs), chunk))
+        outputs = [_Output(p, f_out, layout) for p, f_out in targets]
+        try:
+            # the first chunk runs even for an empty tree, so that the output trees exist
+            for start in xrange(0, max(1, n_entries), chunk):
+                xarr = rnp.tree2array(tree, 
+                                      branches = formulas, 
+                                      selection = cut, 
+                                      start = start, 
+                                      stop = start + chunk)
+                for o in outputs:
+                    o.fill(xarr[xarr[o.proc.cut] != 0] if masked else xarr)
+                del xarr
+        except ValueError as e:
+            if len(targets) == 1:
+                raise
+            logger.warning('fitting_forest._SharedRead.stream', 
+                           'Shared read failed (%s), reading each process separately'%str(e))
+            for o in outputs:
+                o.discard()
+            for target in targets:
+                self.stream([target], layout, max_memory)
+            return
+        finally:
+            cleanup()
+        for o in outputs:
+            o.close()
+        self.__done(len(targets))
+
+
+def _shared_read(tree):
+    global _reads
+    if id(tree) not in _reads:
+        _reads[id(tree)] = _SharedRead(tree)
+    return _reads[id(tree)]
+
+
 class Process:
-    def __init__(self, name, tree, cut, variables, weights):
+    def __init__(self, name, tree, cut, variables, weights, files=None):
         '''        
         Arguments:
             name {str} -- name of this process
@@ -24,12 +247,12 @@ class Process:
             cut {str} -- selection to apply
             variables {dict} -- map : output branch name -> input formula
             weights {dict} -- map : systematic shift name -> input formula
+            files {list} -- paths of the input files, taken from tree if not given
         '''
         self.name = name 
-        self.tree = tree
-        self.cut = cut 
+        self.cut = cut or '1'
         self.variables = variables
-        self.__outputs = {}
+        self.files = files if files is not None else input_files(tree)
         if not weights:
             self.weights = {}
             self.nominal_weight = '1'
@@ -43,28 +266,70 @@ class Process:
         self.all_branches = self.variables.copy()
         self.all_branches.update(self.weights)
         self.all_branches['nominal'] = self.nominal_weight
-    def __write_out(self, f_out, xarr, fields, postfix):
-        repl = {self.all_branches[f] : (f if f in self.variables else 'weight') for f in fields}
-        varr = xarr[list(set(repl.keys()))]
-        root_interface.rename_dtypes(varr, repl)
-        root_interface.array_as_tree(xarr = varr, 
-                                     treename = self.name+postfix, 
-                                     fcontext = f_out)
-    def run(self, f_out):
+        self.rebind(tree)
+    def rebind(self, tree):
+        '''
+        Read from tree instead, e.g. after a fork, where the parent's file handles cannot be shared
+        '''
+        self.tree = tree
+        self.reader = _shared_read(tree)
+        self.reader.add(self)
+    def tables(self, layout):
+        '''
+        Returns:
+            list of (output tree postfix, [(output branch name, input formula)])
+        '''
+        variables = sorted(self.variables.iteritems())
+        shifts = sorted(self.weights.iteritems())
+        nominal = [('weight', self.nominal_weight)]
+        if layout == 'columns':
+            return [('', variables + nominal + [('weight_'+s, w) for s, w in shifts])]
+        return [('', variables + nominal)] + \
+               [('_'+s, ([] if layout == 'friends' else variables) + [('weight', w)]) 
+                for s, w in shifts]
+    def run(self, f_out, layout='trees', max_memory=None):
+        '''
+        Arguments:
+            f_out {ROOT.TFile} -- output file
+            layout {str} -- one of layouts
+            max_memory {float} -- if set, stream the input in chunks of about this many MB
+        '''
         logger.info('fitting_forest.Process.run', 'Running '+self.name)
-        branches = sorted(self.all_branches.values())
         try:
-            xarr = root_interface.read_tree(tree = self.tree, 
-                                            branches = branches, 
-                                            cut = self.cut)
-            fields = self.variables.keys()+['nominal']
-            self.__write_out(f_out, xarr, fields, '')
-            for shift, weight in self.weights.iteritems():
-                fields = self.variables.keys()+[shift]
-                self.__write_out(f_out, xarr, fields, '_'+shift)
+            if max_memory:
+                self.reader.stream([(self, f_out)], layout, max_memory)
+                return
+            xarr = self.reader.get(self)
         except ValueError as e:
-            logger.error('fitting_forest.Process.run', str(e))
-            return
+            logger.error('fitting_forest.Process.run', '%s failed: %s'%(self.name, str(e)))
+            raise
+        for postfix, columns in self.tables(layout):
+            root_interface.array_as_tree(xarr = _as_array(xarr, columns), 
+                                         treename = self.name+postfix, 
+                                         fcontext = f_out)
+
+
+def _run(targets, layout, max_memory):
+    '''
+    Arguments:
+        targets {list} -- (Process, output ROOT.TFile)
+    '''
+    if not max_memory:
+        for proc, f_out in targets:
+            proc.run(f_out, layout)
+        return
+    # streamed processes of the same tree are written in one pass over it
+    readers = []
+    by_reader = {}
+    for proc, f_out in targets:
+        if id(proc.reader) not in by_reader:
+            readers.append(proc.reader)
+            by_reader[id(proc.reader)] = []
+        by_reader[id(proc.reader)].append((proc, f_out))
+    for reader in readers:
+        logger.info('fitting_forest._run', 
+                    'Running '+', '.join([p.name for p, _ in by_reader[id(reader)]]))
+        reader.stream(by_reader[id(reader)], layout, max_memory)
 
 
 class RegionFactory:
@@ -93,8 +358,10 @@ class RegionFactory:
                 _files[input_info] = root.TFile.Open(input_info)
                 tree = _files[input_info].FindObjectAny(treename)
                 _trees[input_info] = tree 
+            files = [input_info]
         else: # assume it's a TTree
             tree = input_info
+            files = input_files(tree)
         weights = None 
         if is_data:
             if extra_weights:
@@ -108,15 +375,141 @@ class RegionFactory:
         if not is_data:
             variables_.update(self.mc_variables)
         pname += '_' + self.name
-        proc = Process(pname, tree, cut, variables_, weights)
+        proc = Process(pname, tree, cut, variables_, weights, files)
         if is_data:
             self.__data_procs.append(proc)
         else:
             self.__mc_procs.append(proc)
-    def run(self, f_out_path):
+    def processes(self):
+        return list(chain(self.__data_procs, self.__mc_procs))
+    def run(self, f_out_path, layout='trees', max_memory=None):
+        '''
+        Arguments:
+            f_out_path {str} -- output file
+            layout {str} -- how the systematic weights are written, one of layouts
+            max_memory {float} -- if set, stream the inputs in chunks of about this many MB
+        '''
+        if layout not in layouts:
+            raise ValueError('Unknown layout %s, choose one of %s'%(layout, ', '.join(layouts)))
         f_out = root.TFile.Open(f_out_path, 'RECREATE')
-        for proc in chain(self.__data_procs, self.__mc_procs):
-            proc.run(f_out)
-        f_out.Close() 
+        try:
+            _run([(proc, f_out) for proc in self.processes()], layout, max_memory or memory_budget)
+        finally:
+            f_out.Close() 
         logger.info('fitting_forest.RegionFactory.run', 'Created output in %s'%f_out_path)
 
+
+def _reopen(files, name):
+    if len(files) > 1:
+        chain_ = root.TChain(name)
+        for f in files:
+            chain_.AddFile(f)
+        return chain_, None
+    f = root.TFile.Open(files[0])
+    return f.Get(name), f
+
+
+def _split(proc):
+    '''
+    Returns:
+        one copy of proc per input file, each reading only that file. the copies 
+        are bound to a tree when their group runs
+    '''
+    if len(proc.files) == 1:
+        return [proc]
+    pieces = []
+    for f in proc.files:
+        piece = copy(proc)
+        piece.files = [f]
+        pieces.append(piece)
+    return pieces
+
+
+def _run_group(i_group):
+    global _reads
+    _reads = {} # the parent's bookkeeping is not ours
+    group, outputs, layout, max_memory = _groups[i_group]
+    # open the input again in this process, and let all the processes of the 
+    # group that read the same tree share a read of it
+    trees = {}
+    for _, procs in group:
+        for proc in procs:
+            key = (tuple(proc.files), proc.tree.GetName())
+            if key not in trees:
+                trees[key] = _reopen(proc.files, proc.tree.GetName())
+            proc.rebind(trees[key][0])
+    written = []
+    targets = []
+    for i_region, procs in group:
+        tmp_path = '%s_%i.tmp.root'%(path.splitext(outputs[i_region])[0], i_group)
+        f_out = root.TFile.Open(tmp_path, 'RECREATE')
+        targets += [(proc, f_out) for proc in procs]
+        written.append((i_region, tmp_path, f_out))
+    try:
+        _run(targets, layout, max_memory)
+    finally:
+        for _, _, f_out in written:
+            f_out.Close()
+        for _, f in trees.itervalues():
+            if f:
+                f.Close()
+    return [(i_region, tmp_path) for i_region, tmp_path, _ in written]
+
+
+def run_regions(factories, f_out_paths, n_jobs=None, layout='trees', max_memory=None):
+    '''
+    Run several regions at once: processes are grouped by input file (a process
+    over several files, e.g. a TChain, is split into one piece per file), each 
+    file is read once for all the processes of all regions that include it, 
+    and the groups run in parallel. Each group writes a temporary file per 
+    region, which are hadded into the outputs at the end
+
+    Arguments:
+        factories {list} -- RegionFactory objects, with their processes added
+        f_out_paths {list} -- output file of each factory
+        n_jobs {int} -- number of groups to run at once, defaults to the number of cores
+        layout {str} -- how the systematic weights are written, one of layouts
+        max_memory {float} -- if set, stream the inputs in chunks of about this many MB, per job
+    '''
+    global _groups
+    if layout not in layouts:
+        raise ValueError('Unknown layout %s, choose one of %s'%(layout, ', '.join(layouts)))
+    by_file = {} # input file -> region index -> processes
+    for i_region, factory in enumerate(factories):
+        for proc in factory.processes():
+            for piece in _split(proc):
+                by_file.setdefault(piece.files[0], {}).setdefault(i_region, []).append(piece)
+    _groups = [(sorted(regions.iteritems()), f_out_paths, layout, max_memory or memory_budget) 
+               for _, regions in sorted(by_file.iteritems())]
+    logger.info('fitting_forest.run_regions', 
+                '%i regions read from %i input files'%(len(factories), len(_groups)))
+
+    n_jobs = min(n_jobs or mp.cpu_count(), max(1, len(_groups)))
+    if n_jobs > 1:
+        pool = mp.Pool(n_jobs)
+        results = pool.map(_run_group, range(len(_groups)), chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_run_group, range(len(_groups)))
+
+    to_hadd = [[] for _ in factories]
+    for i_region, tmp_path in chain.from_iterable(results):
+        to_hadd[i_region].append(tmp_path)
+    failed = []
+    for f_out_path, tmp_paths in zip(f_out_paths, to_hadd):
+        if tmp_paths:
+            ret = system('hadd -k -f %s %s'%(f_out_path, ' '.join(tmp_paths)))
+            if ret:
+                # keep the pieces, they can still be hadded by hand
+                logger.error('fitting_forest.run_regions', 
+                             'hadd into %s exited with %i, keeping %s'%(f_out_path, ret, ' '.join(tmp_paths)))
+                failed.append(f_out_path)
+                continue
+        else:
+            root.TFile.Open(f_out_path, 'RECREATE').Close()
+        for f in tmp_paths:
+            remove(f)
+        logger.info('fitting_forest.run_regions', 'Created output in %s'%f_out_path)
+    if failed:
+        raise RuntimeError('Could not create %s'%(', '.join(failed)))
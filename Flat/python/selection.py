@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
-from PandaCore.Utils.load import Load 
+from PandaCore.Utils.load import Load
 from PandaCore.Utils.logging import logger
 import ROOT as root
 import cppyy
 import sys
+import fcntl
+import hashlib
+from os import getenv, path, makedirs
+from re import sub
 
 # this module lets you build a LambdaSelection instance on the fly
 
@@ -12,21 +16,119 @@ import sys
 this = sys.modules[__name__]
 
 Load('PandaAnalyzer')
-cppyy.cppdef('#include "PandaAnalysis/Flat/interface/GeneralTree.h"')
+_header = '#include "PandaAnalysis/Flat/interface/GeneralTree.h"'
+cppyy.cppdef(_header)
+
+_cachedir = getenv('PANDA_SELCACHE') # directory of precompiled selection libraries, shared by jobs
+_compiled = {} # normalized expression -> compiled std::function
+expressions = {} # name given to build -> normalized expression, e.g. for event_index
+
+# the same expression, however it is spaced, is compiled once and always
+# gets the same symbol, so names never collide
+def normalize(expr):
+    return sub(r'\s+', ' ', expr).strip()
+
+def _symbol(expr):
+    return 'panda_sel_' + hashlib.md5(expr).hexdigest()[:16]
+
+def _definition(expr):
+    return ('std::function<bool(const GeneralTree* gt)> %s = '
+            '[](const GeneralTree* gt) { return %s; };\n')%(_symbol(expr), expr)
+
+# what a compiled library depends on besides the expressions: the layout of
+# GeneralTree, and the ROOT build it was compiled with
+def _build_key():
+    h = hashlib.md5()
+    header = path.join(getenv('CMSSW_BASE', ''), 'src/PandaAnalysis/Flat/interface/GeneralTree.h')
+    try:
+        with open(header, 'rb') as fheader:
+            h.update(fheader.read())
+    except IOError:
+        return None
+    h.update(root.gROOT.GetVersion())
+    h.update(root.gSystem.GetBuildArch())
+    h.update(getenv('SCRAM_ARCH', ''))
+    return h.hexdigest()
+
+# compile the definitions with ACLiC into _cachedir, or reuse what another job
+# compiled. returns False if the library cannot be used
+def _load_library(exprs):
+    build_key = _build_key()
+    if build_key is None: # cannot tell whether a library is stale
+        return False
+    key = hashlib.md5(build_key + '\n' + '\n'.join(exprs)).hexdigest()[:16]
+    base = path.join(_cachedir, 'panda_sel_lib_' + key)
+    try:
+        if not path.isdir(_cachedir):
+            makedirs(_cachedir)
+    except OSError: # someone else made it
+        pass
+    try:
+        with open(base + '.lock', 'w') as flock:
+            fcntl.flock(flock, fcntl.LOCK_EX)
+            try:
+                if not path.isfile(base + '.so'):
+                    logger.info('selection._load_library', 'Compiling %s.so'%base)
+                    with open(base + '.C', 'w') as fsrc:
+                        fsrc.write(_header + '\n#include <functional>\n')
+                        for expr in exprs:
+                            fsrc.write(_definition(expr))
+                    if getenv('CMSSW_BASE'):
+                        root.gSystem.AddIncludePath('-I%s/src'%getenv('CMSSW_BASE'))
+                    if not root.gSystem.CompileMacro(base + '.C', 'kO',
+                                                     path.basename(base), _cachedir):
+                        return False
+            finally:
+                fcntl.flock(flock, fcntl.LOCK_UN)
+    except IOError as e: # e.g. the cache is not writable
+        logger.warning('selection._load_library', str(e))
+        return False
+    return root.gSystem.Load(base + '.so') >= 0
+
+def define(*exprs):
+    '''
+    Compile selection expressions that have not been compiled yet, in one go
+
+    Returns:
+        list of the compiled functions, in the order of exprs
+    '''
+    exprs = [normalize(x) for x in exprs]
+    missing = sorted(set([x for x in exprs if x not in _compiled]))
+    missing = [x for x in missing if not hasattr(cppyy.gbl, _symbol(x))]
+    if missing:
+        if not (_cachedir and _load_library(missing) 
+                and all([hasattr(cppyy.gbl, _symbol(x)) for x in missing])):
+            if _cachedir:
+                logger.warning('selection.define', 'Could not use %s, compiling in memory'%_cachedir)
+            cppyy.cppdef(''.join([_definition(x) for x in missing]))
+    for x in exprs:
+        if x not in _compiled:
+            _compiled[x] = getattr(cppyy.gbl, _symbol(x))
+    return [_compiled[x] for x in exprs]
 
 def build(stage, name, expr, anded=False):
-    left = 'std::function<bool(const GeneralTree* gt)>'
-    middle = '_fsel = [](const GeneralTree* gt) { return '
-    right = '; };'
-    cppyy.cppdef(left + name + middle + expr + right)
-    f = getattr(cppyy.gbl, name+'_fsel')
+    f, = define(expr)
+    expressions[name] = normalize(expr)
     sel = root.LambdaSel(stage, name, f, anded)
     setattr(this, name+'Sel', sel)
     return sel
 
+def build_all(specs):
+    '''
+    Arguments:
+        specs {list} -- (stage, name, expr, anded), as the arguments of build
+    Returns:
+        list of LambdaSel, all compiled together
+    '''
+    define(*[s[2] for s in specs])
+    return [build(*s) for s in specs]
+
 # e.g.:
-# build(root.Selection.sReco, 'Trigger', '(gt->isData==0) || (gt->trigger!=0)', anded=True) 
+# build(root.Selection.sReco, 'Trigger', '(gt->isData==0) || (gt->trigger!=0)', anded=True)
 # build(root.Selection.sGen, 'GenBosonPt', 'gt->trueGenBosonPt > 100')
 # build(root.Selection.sReco, 'FatJet', 'gt->fj1Pt>250')
 # build(root.Selection.sReco, 'FatJet450', 'gt->fj1Pt>450')
 # build(root.Selection.sGen, 'GenFatJet', 'gt->genFatJetPt>400')
+# or, compiled at once:
+# build_all([(root.Selection.sReco, 'FatJet', 'gt->fj1Pt>250', False),
+#            (root.Selection.sGen, 'GenFatJet', 'gt->genFatJetPt>400', False)])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+'''
+Checks that fitting_forest.run_regions reads each input file once, when a
+process over a TChain and a single-file process of another region overlap:
+ - one group per input file, the shared file holding both regions
+ - one read per input file
+ - the outputs hold the same events as the regions run one by one
+'''
+
+import tempfile
+from os import path
+from shutil import rmtree
+
+import numpy as np
+import root_numpy as rnp
+import ROOT as root
+import PandaAnalysis.Flat.fitting_forest as forest
+
+tmpdir = tempfile.mkdtemp()
+inputs = []
+for i, n in enumerate([100, 50]):
+    fpath = path.join(tmpdir, 'vjets_%i.root'%i)
+    arr = np.zeros(n, dtype=[('x', 'f4'), ('w', 'f4')])
+    arr['x'] = np.linspace(-1, 1, n)
+    arr['w'] = 1
+    rnp.array2root(arr, fpath, treename=forest.treename, mode='recreate')
+    inputs.append(fpath)
+
+def factories():
+    sig = forest.RegionFactory('sig', 'x > 0', {'x' : 'x'}, {}, {'nominal' : 'w'})
+    chain = root.TChain(forest.treename)
+    for f in inputs:
+        chain.AddFile(f)
+    sig.add_process(chain, 'tAllZvv')
+    cr = forest.RegionFactory('cr', 'x < 0.5', {'x' : 'x'}, {}, {'nominal' : 'w'})
+    cr.add_process(inputs[0], 'Zvv')
+    return [sig, cr]
+
+# count the reads of each file
+reads = {}
+read_tree = forest.root_interface.read_tree
+def counted_read_tree(tree, **kwargs):
+    for f in forest.input_files(tree):
+        reads[f] = reads.get(f, 0) + 1
+    return read_tree(tree=tree, **kwargs)
+forest.root_interface.read_tree = counted_read_tree
+
+outputs = [path.join(tmpdir, 'sig.root'), path.join(tmpdir, 'cr.root')]
+forest.run_regions(factories(), outputs, n_jobs=1)
+assert len(forest._groups) == 2, forest._groups
+shared = [g for g in forest._groups if len(g[0]) == 2]
+assert len(shared) == 1, 'the first file should hold both regions'
+assert reads == dict([(f, 1) for f in inputs]), reads
+
+# the same regions, one at a time
+forest.root_interface.read_tree = read_tree
+for factory, output in zip(factories(), outputs):
+    reference = output.replace('.root', '_ref.root')
+    factory.run(reference)
+    for name in ['tAllZvv_sig', 'Zvv_cr']:
+        f, f_ref = root.TFile.Open(output), root.TFile.Open(reference)
+        t, t_ref = f.Get(name), f_ref.Get(name)
+        if t_ref:
+            assert t and t.GetEntries() == t_ref.GetEntries(), name
+            assert abs(rnp.tree2array(t, 'x').sum() - rnp.tree2array(t_ref, 'x').sum()) < 1e-3, name
+
+rmtree(tmpdir)
+print 'OK: %s'%(', '.join(['%s read %i times'%(path.basename(f), n) for f, n in sorted(reads.items())]))
@@ -2,58 +2,107 @@
 
 from os import getenv,path,popen,system
 from PandaCore.Tools.job_management import *
-import subprocess
 import sys
 import argparse
 from glob import glob
-from re import sub as rsub
+from re import compile as rcompile, IGNORECASE
 import cPickle as pickle
-from itertools import chain 
-from PandaCore.Tools.script import * 
-
-## TODO: matrix of errors correlated with
-## hosts where job was running
+import multiprocessing as mp
+from PandaCore.Tools.script import *
 
 logdir = getenv('SUBMIT_LOGDIR')
 workdir = getenv('SUBMIT_WORKDIR')
 args = parse(('--submission', {'type':int, 'nargs':'+', 'default':None}),
              ('--verbose', STORE_TRUE),
              ('--dump', STORE_TRUE),
+             ('--hosts', STORE_TRUE),
+             ('--nproc', {'type':int, 'default':mp.cpu_count()}),
              ('--nodone', STORE_TRUE))
-logdirpath = '$SUBMIT_LOGDIR/' if args.submission is None else '$SUBMIT_LOGDIR/[%s]_'%(''.join(map(str,args.submission)))
-
-def sub(x, y, z):
-    return rsub(y, z, x)
+logpattern = logdir + ('/*err' if args.submission is None else '/[%s]_*err'%(''.join(map(str,args.submission))))
+cachepath = workdir + '/analyzeLogs.pkl'
+
+_error_re = rcompile(r'error|fatal', IGNORECASE)
+# logged by T3.reporting.Reporter once the server has taken the report
+_done_re = rcompile(r'/condor/done x[0-9]+ return=<Response \[200\]>')
+_file_re = rcompile(r'pandaf[^ ]*\.root')
+_host_re = rcompile(r'hostname = .*')
+_clean_res = [(rcompile(x), y) for x, y in [
+        (r'\n', ''),
+        (r'[\.0-9A-Za-z\-_]*\.root', 'X.root'),
+        (r'[0-9][0-9][0-9][0-9]+', 'X'),
+        (r'/mnt/hadoop.*root', 'X.root'),
+        (r'/store/user.*root', 'X.root'),
+        (r'/data/t3.*lock', 'X.lock'),
+        (r'branch:.*', ''),
+        (r'/mnt/hadoop.*npz', 'X.npz'),
+        (r'object at [a-zA-Z0-9]*', 'object at ADDRESS'),
+        (r'\033\[91m', ''),
+        (r't3btch[0-9][0-9][0-9]', 't3btchX'),
+    ]]
 
 def clean(x):
     x = x.replace('+', '\+')
-    x = sub(x, r'\n', '')
-    x = sub(x, r'[\.0-9A-Za-z\-_]*\.root', 'X.root')
-    x = sub(x, r'[0-9][0-9][0-9][0-9]+', 'X')
-    x = sub(x, r'/mnt/hadoop.*root', 'X.root')
-    x = sub(x, r'/store/user.*root', 'X.root')
-    x = sub(x, r'/data/t3.*lock', 'X.lock')
-    x = sub(x, r'branch:.*', '')
-    x = sub(x, r'/mnt/hadoop.*npz', 'X.npz')
-    x = sub(x, r'object at [a-zA-Z0-9]*', 'object at ADDRESS') 
-    x = sub(x, r'\033\[91m', '')
-    x = sub(x, r't3btch[0-9][0-9][0-9]', 't3btchX')
-    return x 
-
-cmd = 'grep -i "error\|fatal" %s*err'%logdirpath
-errors_by_file = {}
-for l in subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.readlines():
-    f = sub(l.split(':')[0].split('/')[-1], '.err', '')
-    if f not in errors_by_file:
-        errors_by_file[f] = []
-    msg = clean(l.replace(l.split(':')[0], '')[1:])
-    errors_by_file[f].append(msg)
+    for r, y in _clean_res:
+        x = r.sub(y, x)
+    return x
 
+# everything we need from one log, in a single pass over it
+def scan(fpath):
+    errors = []
+    files = {}
+    hosts = []
+    done = False
+    with open(fpath) as flog:
+        for l in flog:
+            if _error_re.search(l):
+                errors.append(clean(l))
+            if not done and _done_re.search(l):
+                done = True
+            for f in _file_re.findall(l):
+                files[f] = files.get(f, 0) + 1
+            m = _host_re.search(l)
+            if m:
+                hosts.append(m.group(0).strip())
+    return {'errors' : errors, 'files' : files, 'hosts' : hosts, 'done' : done}
+
+def _scan(fpath):
+    return fpath, scan(fpath)
+
+# logs are only parsed again if they changed since the last run
+try:
+    with open(cachepath, 'rb') as fcache:
+        cached = pickle.load(fcache)
+except (IOError, EOFError, pickle.UnpicklingError):
+    cached = {}
+logs = {}
+to_scan = []
+for fpath in glob(logpattern):
+    mtime = path.getmtime(fpath)
+    if fpath in cached and cached[fpath][0] == mtime:
+        logs[fpath] = cached[fpath][1]
+    else:
+        to_scan.append((fpath, mtime))
+if to_scan:
+    mtimes = dict(to_scan)
+    pool = mp.Pool(max(1, args.nproc))
+    for fpath, result in pool.imap_unordered(_scan, mtimes.keys(), chunksize=16):
+        logs[fpath] = result
+        cached[fpath] = (mtimes[fpath], result)
+    pool.close()
+    pool.join()
+    cached = {k : v for k, v in cached.iteritems() if k in logs or path.isfile(k)}
+    with open(cachepath, 'wb') as fcache:
+        pickle.dump(cached, fcache, pickle.HIGHEST_PROTOCOL)
+
+def job_name(fpath):
+    return path.basename(fpath)[:-len('.err')]
+
+info = {job_name(k) : v for k, v in logs.iteritems()}
 
 aggregates = {}
-for f,errors in errors_by_file.iteritems():
-    for e in errors:
-        if e not  in aggregates:
+for f,v in info.iteritems():
+    for e in v['errors']:
+        if e not in aggregates:
             aggregates[e] = set([f])
         else:
             aggregates[e].add(f)
@@ -87,12 +136,9 @@ if args.dump:
     system('mkdir -p logs_dump')
     system('rm -f logs_dump/*')
 
-done = set([])
-cmd = r'grep -i "report_done.*Response \[200\]"  %s*err'%logdirpath
-for l in subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.readlines():
-    f = sub(l.split(':')[0].split('/')[-1], '.err', '')
-    done.add(f)
+done = set([f for f,v in info.iteritems() if v['done']])
 
+matrix = {} # host -> failure class -> number of jobs
 for i,c in enumerate(correlations):
     if args.verbose:
         print 'Failed with error class %i:'%i
@@ -101,19 +147,18 @@ for i,c in enumerate(correlations):
     for f in sorted(aggregates[list(c)[0]]):
         if args.nodone and f in done:
             continue
-        cmd = 'grep -o "pandaf[^ ]*\.root" $SUBMIT_LOGDIR/%s.err'%(f)
-        for l in subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.readlines():
-            ll = l.strip()
+        for ll,n in info[f]['files'].iteritems():
             if ll not in files:
                 files[ll] = 0
-            files[ll] += 1
-        if args.dump:
-            cmd = 'grep -o "hostname = .*" $SUBMIT_LOGDIR/%s.err'%(f)
-            for l in subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.readlines():
-                ll = l.strip()
+            files[ll] += n
+        for ll in info[f]['hosts']:
+            if args.dump:
                 if ll not in hosts:
                     hosts[ll] = set([])
                 hosts[ll].add( '%s/%s.err'%(logdir, f) )
+            host = ll.replace('hostname = ', '')
+            matrix.setdefault(host, {})
+            matrix[host][i] = matrix[host].get(i, 0) + 1
     if args.verbose:
         for f,n in files.iteritems():
             print '   ',f,n
@@ -121,7 +166,7 @@ for i,c in enumerate(correlations):
         try:
             print 'Failure class %2i failed on %3i files, an average of %.1f times'%(i, len(files), float(sum(files.values())) / len(files) / 2) # each file appears in error logs twice
         except ZeroDivisionError:
-            print 'Failure class %2i failed on %3i jobs, but number of files is unknown'%(i, len(aggregates[list(c)[0]])) 
+            print 'Failure class %2i failed on %3i jobs, but number of files is unknown'%(i, len(aggregates[list(c)[0]]))
     if args.dump:
         with open('logs_dump/class_%i.log'%i, 'w') as fdump:
             fdump.write('Error summary:\n')
@@ -132,3 +177,11 @@ for i,c in enumerate(correlations):
                 for vv in v:
                     fdump.write('\t' + vv + '\n')
 
+if args.hosts:
+    # which hosts the jobs of each failure class ran on
+    n_classes = len(correlations)
+    width = max([len(h) for h in matrix] + [4])
+    print ''
+    print ('%%-%is'%width)%'Host' + ''.join([' %5i'%i for i in xrange(n_classes)])
+    for h in sorted(matrix, key=lambda x : -sum(matrix[x].values())):
+        print ('%%-%is'%width)%h + ''.join([' %5i'%matrix[h].get(i, 0) for i in xrange(n_classes)])
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 from glob import glob
-from os import stat,getenv,system,path
+from os import stat,getenv,system,path,makedirs,rename
+from multiprocessing.pool import ThreadPool
+import cPickle as pickle
+from packing import local_path
 from PandaCore.Tools.script import * 
 from re import sub, match
 from sys import argv
@@ -17,7 +20,11 @@ args = parse(('--catalog',{'type':str, 'default':'/home/cmsprod/catalog/t2mit/pa
              ('--exclude', {'nargs':'+', 'default':None}),
              ('--smartcache', STORE_TRUE),
              ('--force', STORE_TRUE),
-             ('--max_files', {'type':int, 'default':-1}))
+             ('--max_files', {'type':int, 'default':-1}),
+             ('--nthreads', {'type':int, 'default':8}),
+             ('--cache', {'default':path.join(getenv('HOME'), '.pandaanalysis', 'catalog.pkl')}),
+             ('--no_cache', STORE_TRUE),
+             ('--sizes', STORE_TRUE))
 
 args.catalog = '/' + args.catalog.strip('/')
 if not args.mc_catalog:
@@ -41,8 +48,11 @@ class CatalogSample:
         self.dtype = dtype
         self.xsec = xsec
         self.files = []
-    def add_file(self,f):
+        self.meta = {}
+    def add_file(self,f,meta=None):
         self.files.append(f)
+        if meta is not None:
+            self.meta[f] = meta
     def get_lines(self,smartcache_args=None,max_lines=-1):
         lines = []
         nickname = self.name+'_%i'
@@ -50,7 +60,11 @@ class CatalogSample:
             ds_ = f.split('/')[-2]
             f_ = f.split('/')[-1]
             book_ = '/'.join(args.catalog.split('/')[-2:])
-            lines.append('{0:<25} {2:<10} {3:<15} {1}\n'.format(nickname,f,self.dtype,self.xsec)) 
+            if f in self.meta:
+                # optional 5th column, size:entries (-1 if unknown)
+                lines.append('{0:<25} {2:<10} {3:<15} {1} {4}:{5}\n'.format(nickname,f,self.dtype,self.xsec,*self.meta[f]))
+            else:
+                lines.append('{0:<25} {2:<10} {3:<15} {1}\n'.format(nickname,f,self.dtype,self.xsec)) 
             if smartcache_args is not None:
                 smartcache_args.append(ds_)
         if max_lines > 0:
@@ -88,8 +102,45 @@ samples = {}
 
 could_not_find = []
 
+# dataset directory -> ((mtime of directory, mtimes of RawFiles), files, [(size, entries)] or None)
+dataset_cache = {}
+if not args.no_cache:
+    try:
+        with open(args.cache, 'rb') as fcache:
+            dataset_cache = pickle.load(fcache)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+
+# list the files of a dataset, unless neither the directory nor its RawFiles changed
+def scan_dataset(d):
+    rawfiles = glob(d+'/RawFiles.*')
+    stamp = (stat(d).st_mtime, tuple([(rf, stat(rf).st_mtime) for rf in rawfiles]))
+    cached = dataset_cache.get(d)
+    if cached and len(cached) == 3 and cached[0] == stamp and (cached[2] or not args.sizes):
+        return cached
+    files = []
+    entries = []
+    for rfpath in rawfiles:
+        rawfile = open(rfpath)
+        for line in rawfile:
+            ll = line.split()
+            files.append(ll[0])
+            # the second column of RawFiles, if present, is the number of events
+            entries.append(int(ll[1]) if len(ll) > 1 and ll[1].isdigit() else -1)
+    meta = None
+    if args.sizes:
+        meta = []
+        for f, n in zip(files, entries):
+            try:
+                size = stat(local_path(f)).st_size
+            except OSError:
+                size = -1
+            meta.append((size, n))
+    return (stamp, files, meta)
+
 def cat(catalog, condition=lambda x : True): 
     global samples, could_not_find
+    to_scan = []
     for d in sorted(glob(catalog+'/*')):
         dirname = d.split('/')[-1]
         if not condition(dirname):
@@ -112,11 +163,17 @@ def cat(catalog, condition=lambda x : True):
         if properties[0] not in samples:
             samples[properties[0]] = CatalogSample(*properties)
         logger.info(argv[0], 'Selecting %s'%properties[0])
-        sample = samples[properties[0]]
-        for rfpath in glob(d+'/RawFiles.*'):
-            rawfile = open(rfpath)
-            for line in rawfile:
-                sample.add_file(line.split()[0])
+        to_scan.append((d, samples[properties[0]]))
+
+    # the directories are scanned in parallel, but files are added in the same order as before
+    pool = ThreadPool(max(1, args.nthreads))
+    scanned = pool.map(scan_dataset, [x[0] for x in to_scan])
+    pool.close()
+    for (d, sample), scan in zip(to_scan, scanned):
+        dataset_cache[d] = scan
+        stamp, files, meta = scan
+        for i,f in enumerate(files):
+            sample.add_file(f, meta[i] if (meta and args.sizes) else None)
 
 cat(args.mc_catalog, lambda x : bool(match('.*SIM$', x)))
 cat(args.data_catalog, lambda x : bool(match('.*AOD$', x)))
@@ -124,6 +181,13 @@ if args.user_catalog:
     cat(args.catalog.replace('cmsprod',user))
     cat(args.catalog.replace('cmsprod',user).replace('t2','t3'))
 
+if not args.no_cache:
+    if not path.isdir(path.dirname(args.cache)):
+        makedirs(path.dirname(args.cache))
+    with open(args.cache + '.tmp', 'wb') as fcache:
+        pickle.dump(dataset_cache, fcache, pickle.HIGHEST_PROTOCOL)
+    rename(args.cache + '.tmp', args.cache)
+
 if len(could_not_find)>0:
     logger.warning(argv[0],"Could not properly catalog following datasets (force=%s)"%('True' if args.force else 'False'))
     for c in could_not_find:
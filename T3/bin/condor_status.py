@@ -0,0 +1,138 @@
+import json
+import cPickle as pickle
+from os import path
+from re import compile as rcompile
+from time import time
+
+import PandaCore.Tools.job_management as jm
+
+_cluster_re = rcompile(r'ClusterId\s*=\?=\s*([0-9]+)')
+_owner_re = rcompile(r'Owner\s*=\?=\s*"[^"]*"')
+
+
+# wraps a schedd so that every per-cluster query (as issued by
+# Submission.query_status) is answered from a single query for all clusters
+# of the task, which is repeated at most once per ttl seconds
+class CachedSchedd(object):
+    def __init__(self, schedd, ttl=30):
+        self._schedd = schedd
+        self.ttl = ttl
+        self.cluster_ids = set([])
+        self.finished = set([])  # clusters that have fully left the queue
+        self._cache = {}         # (constraint, attrs) -> (time, {cluster_id : [jobs]}, queried clusters, n)
+        self._n_queries = 0      # n of the latest query to the schedd
+        self._empty = {}         # cluster_id -> n of the first query in a row that saw no jobs
+
+    def __getattr__(self, name):
+        return getattr(self._schedd, name)
+
+    def invalidate(self):
+        self._cache = {}
+
+    def act(self, *args, **kwargs):
+        self.invalidate()
+        return self._schedd.act(*args, **kwargs)
+
+    def query(self, constraint='true', attr_list=None, *args, **kwargs):
+        attr_list = list(attr_list or [])
+        m = _cluster_re.search(constraint)
+        if m is None:
+            return self._schedd.query(constraint, attr_list, *args, **kwargs)
+        cluster_id = int(m.group(1))
+        if cluster_id in self.finished:
+            return []
+        self.cluster_ids.add(cluster_id)
+
+        # the same query for every live cluster of the task
+        template = constraint[:m.start()] + '%s' + constraint[m.end():]
+        key = (template, tuple(attr_list))
+        now = time()
+        if key not in self._cache or now - self._cache[key][0] > self.ttl \
+           or cluster_id not in self._cache[key][2]:
+            live = sorted(self.cluster_ids - self.finished)
+            clusters = '(%s)'%(' || '.join(['ClusterId =?= %i'%x for x in live]))
+            if attr_list and 'ClusterId' not in attr_list:
+                attr_list.append('ClusterId')
+            by_cluster = {x : [] for x in live}
+            for job in self._schedd.query(template%clusters, attr_list, *args, **kwargs):
+                by_cluster.setdefault(int(job['ClusterId']), []).append(job)
+            self._n_queries += 1
+            self._cache[key] = (now, by_cluster, set(live), self._n_queries)
+        return self._cache[key][1].get(cluster_id, [])
+
+    # clusters that two separate queries in a row saw no jobs for are done for good,
+    # a single empty answer can be a hiccup of the schedd.
+    # only queries that select nothing but the owner and cluster can tell
+    def update_finished(self):
+        for (template, _), (_, by_cluster, queried, n) in self._cache.iteritems():
+            if _owner_re.sub('', template).replace('%s', '').strip(' ()&\t') != '':
+                continue
+            for cluster_id in queried:
+                if by_cluster.get(cluster_id):
+                    self._empty.pop(cluster_id, None)
+                elif cluster_id not in self._empty:
+                    self._empty[cluster_id] = n
+                elif self._empty[cluster_id] != n:
+                    self.finished.add(cluster_id)
+
+
+# status of all submissions of a task, shared by check, query and kill
+class TaskStatus(object):
+    def __init__(self, workdir, ttl=30):
+        self.pklpath = workdir + '/submission.pkl'
+        self.finishedpath = workdir + '/finished_clusters.json'
+        if getattr(jm, 'schedd', None) is not None and not isinstance(jm.schedd, CachedSchedd):
+            jm.schedd = CachedSchedd(jm.schedd, ttl)
+        self.schedd = getattr(jm, 'schedd', None)
+        if not isinstance(self.schedd, CachedSchedd):
+            self.schedd = CachedSchedd(self.schedd, ttl)
+        try:
+            with open(self.finishedpath) as ffinished:
+                self.schedd.finished.update(json.load(ffinished))
+        except (IOError, ValueError):
+            pass
+        self._mtime = None
+        self._submissions = []
+
+    def submissions(self):
+        '''
+        Returns:
+            list of Submission objects, re-read only if submission.pkl changed
+        '''
+        if not path.isfile(self.pklpath):
+            return []
+        mtime = path.getmtime(self.pklpath)
+        if mtime != self._mtime:
+            with open(self.pklpath, 'rb') as fpkl:
+                self._submissions = pickle.load(fpkl)
+            self._mtime = mtime
+            # register every cluster up front, so the first query covers all of them
+            self.schedd.cluster_ids.update([s.cluster_id for s in self._submissions 
+                                            if s.cluster_id is not None])
+        return self._submissions
+
+    def live(self):
+        return [s for s in self.submissions() if s.cluster_id not in self.schedd.finished]
+
+    def query(self):
+        '''
+        Returns:
+            list of (Submission, status) for submissions that still have jobs in the queue
+        '''
+        results = [(s, s.query_status()) for s in self.live()]
+        n_finished = len(self.schedd.finished)
+        self.schedd.update_finished()
+        if len(self.schedd.finished) != n_finished:
+            with open(self.finishedpath, 'w') as ffinished:
+                json.dump(sorted(self.schedd.finished), ffinished)
+        return results
+
+    def invalidate(self):
+        self.schedd.invalidate()
+
+
+_status = {}
+def get_status(workdir, ttl=30):
+    if workdir not in _status:
+        _status[workdir] = TaskStatus(workdir, ttl)
+    return _status[workdir]
@@ -0,0 +1,150 @@
+import json
+from glob import glob
+from os import path
+from re import compile as rcompile
+
+_host_re = rcompile(r'hostname = (\S+)')
+_request_re = rcompile(r'request_data\S*\s+(root://\S+\.root)')
+_time_re = rcompile(r'([0-9.]+) s elapsed performing "([^"]*)"')
+_record_re = rcompile(r'TIMING (\{.*\})')
+_failed_re = rcompile(r'Could not stage in (root://\S+\.root)')
+_cache = {}  # log path -> (mtime, JobLog)
+
+
+def panda_id(fpath):
+    '''
+    Arguments:
+        fpath {str} -- catalog path, or the name a job gave its local copy
+    Returns:
+        the id that job_utilities.request_data uses to name local copies
+    '''
+    return fpath.split('/')[-1].split('_')[-1].replace('.root', '')
+
+
+class JobLog(object):
+    def __init__(self, name):
+        self.name = name
+        self.host = None
+        self.requested = {}  # panda_id -> catalog path
+        self.timings = []    # (label, seconds), in order
+        self.analyzed = {}   # catalog path -> seconds spent analyzing it
+        self.staged = {}     # catalog path -> seconds spent waiting for it
+        self.events = {}     # catalog path -> number of events analyzed
+        self.failed = set()  # catalog paths that could not be staged in
+        self.finished = False
+        self.mtime = None
+
+    def crashed(self):
+        '''
+        Returns:
+            the file the job was analyzing when it died, if any
+        '''
+        if self.finished:
+            return None
+        current = None
+        for label, _ in self.timings:
+            f = self.resolve(label)
+            if f is None:
+                continue
+            if label.startswith('copy ') or label.startswith('wait for data '):
+                current = f # staged, analysis starts next
+            elif label.startswith('analyze ') or label.startswith('remove '):
+                current = None
+        return current
+
+    def running(self, running_files):
+        '''
+        Arguments:
+            running_files {set} -- catalog paths of the files of running or idle jobs
+        Returns:
+            whether this may be the log of a job that has not ended yet
+        '''
+        return not self.finished and any([f in running_files 
+                                          for f in self.requested.itervalues()])
+
+    def failed_stagein(self):
+        '''
+        Returns:
+            files whose stage-in failed. files that were only prefetched before
+            the job ended are not counted, as they never had the chance
+        '''
+        return [f for f in self.failed 
+                if f not in self.staged and f not in self.analyzed]
+
+    def resolve(self, label):
+        '''
+        Returns:
+            the catalog path of the file in a print_time label, if it is known
+        '''
+        return self.requested.get(panda_id(label.split()[-1]))
+
+
+def parse(fpath):
+    '''
+    Arguments:
+        fpath {str} -- .err log of one job
+    Returns:
+        JobLog with the host, the files it requested and how long each step took
+    '''
+    log = JobLog(path.basename(fpath).replace('.err', ''))
+    with open(fpath) as flog:
+        for l in flog:
+            if log.host is None:
+                m = _host_re.search(l)
+                if m:
+                    log.host = m.group(1)
+                    continue
+            m = _request_re.search(l)
+            if m:
+                xrd_path = m.group(1)
+                log.requested[panda_id(xrd_path)] = xrd_path
+                continue
+            m = _failed_re.search(l)
+            if m:
+                log.failed.add(m.group(1))
+                continue
+            m = _record_re.search(l)
+            if m:
+                try:
+                    record = json.loads(m.group(1))
+                except ValueError: # truncated line
+                    continue
+                if record.get('stage') == 'analyze' and record.get('file') and record.get('events') is not None:
+                    f = log.resolve(record['file'])
+                    if f is not None:
+                        log.events[f] = log.events.get(f, 0) + record['events']
+                continue
+            m = _time_re.search(l)
+            if m:
+                label = m.group(2)
+                seconds = float(m.group(1))
+                log.timings.append((label, seconds))
+                if label.startswith('analyze '):
+                    f = log.resolve(label)
+                    if f is not None:
+                        log.analyzed[f] = log.analyzed.get(f, 0) + seconds
+                elif label.startswith('copy ') or label.startswith('wait for data '):
+                    f = log.resolve(label)
+                    if f is not None:
+                        log.staged[f] = log.staged.get(f, 0) + seconds
+                elif label in ('hadd', 'stageout and cleanup', 'create lock'):
+                    log.finished = True
+    return log
+
+
+def parse_all(logdir, pattern='*.err'):
+    '''
+    Returns:
+        list of JobLog, logs are only parsed again if they changed
+    '''
+    logs = []
+    for f in glob(path.join(logdir, pattern)):
+        try:
+            mtime = path.getmtime(f)
+        except OSError:
+            continue
+        if f not in _cache or _cache[f][0] != mtime:
+            _cache[f] = (mtime, parse(f))
+            _cache[f][1].mtime = mtime
+        logs.append(_cache[f][1])
+    return logs
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+from os import path
+from time import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# filesystems where inotify does not see writes made by other hosts
+_remote_fs = set(['nfs', 'nfs4', 'cifs', 'smbfs', 'afs', 'lustre', 'gpfs', 'hadoop'])
+
+
+def _is_local(d):
+    d = path.realpath(d)
+    best, fstype = '', None
+    with open('/proc/mounts') as fmounts:
+        for l in fmounts:
+            fields = l.split()
+            mnt = fields[1]
+            if (d == mnt or d.startswith(mnt.rstrip('/') + '/')) and len(mnt) > len(best):
+                best, fstype = mnt, fields[2]
+    if fstype is None:
+        return False
+    return not (fstype in _remote_fs or fstype.startswith('fuse'))
+
+
+# lock files are (nearly always) write-once, so we only read a lock again if
+# its mtime changed. the index remembers what each lock contained, keyed by
+# lock name, across refreshes and across invocations of task.py.
+# min_age keeps us from reading a lock that may still be being copied in; 
+# it only makes sense when refreshing repeatedly, e.g. for --monitor
+class LockIndex(object):
+    def __init__(self, lockdir, dbpath, use_inotify=True, min_age=0):
+        self.lockdir = lockdir
+        self.min_age = min_age
+        self.db = sqlite3.connect(dbpath)
+        self.db.execute('CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, mtime REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (lock TEXT, file TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_lock ON files (lock)')
+        self.db.commit()
+        self.known = dict(self.db.execute('SELECT name, mtime FROM locks')) # name -> mtime
+        self.processed = {}
+        for lock, f in self.db.execute('SELECT lock, file FROM files'):
+            self.processed[f] = self.processed.get(f, 0) + 1
+        self._notifier = None
+        self._changed = set([])
+        self._deferred = set([])
+        self._resync = True
+        if use_inotify and pyinotify is not None and path.isdir(lockdir) and _is_local(lockdir):
+            self._watch()
+
+    def _watch(self):
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+               pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_Q_OVERFLOW
+
+        index = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.mask & pyinotify.IN_Q_OVERFLOW:
+                    index._resync = True
+                elif event.name.endswith('lock'):
+                    index._changed.add(event.name)
+
+        self._notifier = pyinotify.Notifier(wm, Handler(), timeout=0)
+        wm.add_watch(self.lockdir, mask)
+
+    def _ingest(self, name, mtime=None):
+        try:
+            if mtime is None:
+                mtime = os.stat(path.join(self.lockdir, name)).st_mtime
+            if self.min_age and time() - mtime < self.min_age:
+                self._deferred.add(name)
+                return
+            with open(path.join(self.lockdir, name)) as flock:
+                files = [l.strip() for l in flock if l.strip()]
+        except (IOError, OSError):
+            return
+        self._deferred.discard(name)
+        if name in self.known: # rewritten
+            self._forget(name)
+        self.db.execute('INSERT OR REPLACE INTO locks VALUES (?, ?)', (name, mtime))
+        self.db.executemany('INSERT INTO files VALUES (?, ?)', [(name, f) for f in files])
+        self.known[name] = mtime
+        for f in files:
+            self.processed[f] = self.processed.get(f, 0) + 1
+
+    def _forget(self, name):
+        for (f,) in self.db.execute('SELECT file FROM files WHERE lock = ?', (name,)):
+            self.processed[f] -= 1
+            if not self.processed[f]:
+                del self.processed[f]
+        self.db.execute('DELETE FROM files WHERE lock = ?', (name,))
+        self.db.execute('DELETE FROM locks WHERE name = ?', (name,))
+        self.known.pop(name, None)
+
+    def refresh(self):
+        '''
+        Returns:
+            set of files that have been recorded as processed by some lock
+        '''
+        if self._notifier is not None:
+            if self._notifier.check_events(0):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        if self._notifier is None or self._resync:
+            # list the directory, but only read the locks that are new or changed
+            try:
+                current = set([x for x in os.listdir(self.lockdir) if x.endswith('lock')])
+            except OSError:
+                current = set([])
+            for name in set(self.known) - current:
+                self._forget(name)
+            for name in current:
+                try:
+                    mtime = os.stat(path.join(self.lockdir, name)).st_mtime
+                except OSError:
+                    continue
+                if self.known.get(name) != mtime:
+                    self._ingest(name, mtime)
+            self._resync = False
+        else:
+            for name in self._changed:
+                self._deferred.discard(name)
+                if path.isfile(path.join(self.lockdir, name)):
+                    self._ingest(name)
+                elif name in self.known:
+                    self._forget(name)
+            # locks that were too fresh to trust when the directory was listed
+            for name in list(self._deferred):
+                self._ingest(name)
+        self._changed = set([])
+        self.db.commit()
+        return set(self.processed)
@@ -0,0 +1,276 @@
+import json
+import heapq
+from os import path, getenv, makedirs
+
+import PandaCore.Tools.job_management as jm
+import job_logs
+
+_model_path = path.join(getenv('HOME'), '.pandaanalysis', 'throughput.json')
+_default_rate = 2e6     # bytes/s analyzed, if nothing has been learned yet
+_default_overhead = 30  # s per file to stage it in
+_sizes = {}             # catalog path -> size on hadoop, files in the catalog do not change
+_histories = {}         # logdir -> ((mtimes of the logs, running files), History)
+
+
+def local_path(xrd_path):
+    '''
+    Returns:
+        where a catalog path lives on hadoop, as in job_utilities.request_data
+    '''
+    if 'scratch' in xrd_path:
+        return xrd_path.replace('root://t3serv006.mit.edu/', '/mnt/hadoop')
+    return xrd_path.replace('root://xrootd.cmsaf.mit.edu/', '/mnt/hadoop/cms')
+
+
+def file_size(f):
+    if f not in _sizes:
+        try:
+            _sizes[f] = path.getsize(local_path(f))
+        except OSError:
+            return None # maybe it shows up later
+    return _sizes[f]
+
+
+def read_catalog_meta(lines):
+    '''
+    Arguments:
+        lines {list} -- lines of a catalog (list.cfg)
+    Returns:
+        dict of catalog path -> (size in bytes, number of events), from the 
+        optional fifth column written by catalogT2Prod.py --sizes. -1 if unknown
+    '''
+    meta = {}
+    for l in lines:
+        ll = l.split()
+        if len(ll) < 5 or l.strip().startswith('#'):
+            continue
+        try:
+            size, entries = ll[4].split(':')
+            meta[ll[3]] = (int(size), int(entries))
+        except ValueError:
+            continue
+    return meta
+
+
+def load_model(tmpl):
+    '''
+    Arguments:
+        tmpl {str} -- path of the skim template, the model is kept per template
+    Returns:
+        dict with the analysis rate ('rate', bytes/s), per-file stage-in time ('overhead', s)
+        and, once it has been measured, the analysis rate in events/s ('events_rate')
+    '''
+    try:
+        with open(_model_path) as fmodel:
+            models = json.load(fmodel)
+    except (IOError, ValueError):
+        models = {}
+    return models.get(path.basename(tmpl), {'rate' : _default_rate,
+                                            'overhead' : _default_overhead,
+                                            'n_files' : 0})
+
+
+def learn(logdir, tmpl):
+    '''
+    Update the model of tmpl from the print_time records in the logs of a previous run.
+    Has to be called before the logs are cleaned up.
+
+    Returns:
+        the updated model
+    '''
+    total_bytes = 0
+    total_seconds = 0
+    total_events = 0
+    event_seconds = 0
+    n_files = 0
+    staged = []
+    for log in job_logs.parse_all(logdir):
+        for f, seconds in log.analyzed.iteritems():
+            if seconds <= 0:
+                continue
+            if f in log.events:
+                total_events += log.events[f]
+                event_seconds += seconds
+            size = file_size(f)
+            if size is None:
+                continue
+            total_bytes += size
+            total_seconds += seconds
+            n_files += 1
+        staged += log.staged.values()
+    model = load_model(tmpl)
+    if total_seconds <= 0:
+        return model
+
+    # running average, weighted by the number of files each run saw
+    n_old = model['n_files']
+    rate = total_bytes / total_seconds
+    model['rate'] = (model['rate'] * n_old + rate * n_files) / max(1, n_old + n_files)
+    if staged:
+        overhead = sum(staged) / len(staged)
+        model['overhead'] = (model['overhead'] * n_old + overhead * n_files) / max(1, n_old + n_files)
+    if event_seconds > 0:
+        events_rate = total_events / event_seconds
+        if 'events_rate' in model:
+            events_rate = (model['events_rate'] * n_old + events_rate * n_files) / max(1, n_old + n_files)
+        model['events_rate'] = events_rate
+    model['n_files'] = n_old + n_files
+
+    try:
+        with open(_model_path) as fmodel:
+            models = json.load(fmodel)
+    except (IOError, ValueError):
+        models = {}
+    models[path.basename(tmpl)] = model
+    if not path.isdir(path.dirname(_model_path)):
+        makedirs(path.dirname(_model_path))
+    with open(_model_path, 'w') as fmodel:
+        json.dump(models, fmodel, indent=2)
+    return model
+
+
+def pack(costs, target):
+    '''
+    Arguments:
+        costs {list} -- estimated seconds per file
+        target {float} -- wall time each job should stay below, in s
+    Returns:
+        list of lists of indices into costs, one per job
+    '''
+    order = sorted(xrange(len(costs)), key=lambda i : -costs[i])
+    bins = []  # heap of (load, index of job)
+    jobs = []
+    for i in order:
+        # largest files first, each into the least loaded job if it fits
+        if bins and bins[0][0] + costs[i] <= target:
+            load, j = heapq.heappop(bins)
+        else:
+            load, j = 0, len(jobs)
+            jobs.append([])
+        jobs[j].append(i)
+        heapq.heappush(bins, (load + costs[i], j))
+    return jobs
+
+
+# files are costed by, in order of preference: a previous measurement, the number
+# of events in the catalog, the size in the catalog, the size on hadoop
+def _file_costs(files, model, measured=None, meta=None):
+    measured = measured or {}
+    meta = meta or {}
+    sizes = []
+    for f in files:
+        size = meta.get(f, (-1, -1))[0]
+        sizes.append(size if size >= 0 else file_size(f))
+    known = [x for x in sizes if x is not None]
+    typical = sorted(known)[len(known) / 2] if known else 0
+    costs = []
+    for f, x in zip(files, sizes):
+        entries = meta.get(f, (-1, -1))[1]
+        if f in measured:
+            costs.append(model['overhead'] + measured[f])
+        elif entries >= 0 and model.get('events_rate'):
+            costs.append(model['overhead'] + entries / model['events_rate'])
+        else:
+            costs.append(model['overhead'] + (typical if x is None else x) / model['rate'])
+    return costs
+
+
+def _configs(sample, groups):
+    configs = []
+    for group in groups:
+        packed = jm.DataSample(sample.name, sample.dtype, sample.xsec)
+        for f in group:
+            packed.add_file(f)
+        configs += packed.get_config(len(group), suffix='_%i')
+    return configs
+
+
+def pack_sample(sample, model, target, meta=None):
+    '''
+    Arguments:
+        sample {DataSample} -- one sample of the catalog
+        model {dict} -- from load_model
+        target {float} -- wall time per job, in s
+        meta {dict} -- from read_catalog_meta, optional
+    Returns:
+        list of configs, as from DataSample.get_config(N, suffix='_%i')
+    '''
+    costs = _file_costs(sample.files, model, meta=meta)
+    groups = [[sample.files[i] for i in sorted(job)] for job in pack(costs, target)]
+    return _configs(sample, groups)
+
+
+class History(object):
+    def __init__(self, logdir, logs=None, running_files=None):
+        '''
+        What previous jobs of a task tell us about each file
+
+        Arguments:
+            logdir {str} -- SUBMIT_LOGDIR, holding the logs of all submissions
+            logs {list} -- JobLogs of logdir, if they have been parsed already
+            running_files {set} -- files of running or idle jobs, whose logs are skipped
+        '''
+        self.crashes = {}    # file -> number of jobs that died analyzing it
+        self.transient = {}  # file -> number of failed stage-ins
+        self.seconds = {}    # file -> longest time it took to analyze
+        if logs is None:
+            logs = job_logs.parse_all(logdir)
+        running_files = running_files or set([])
+        for log in logs:
+            if log.running(running_files):
+                continue # not dead, just not done yet
+            f = log.crashed()
+            if f is not None:
+                self.crashes[f] = self.crashes.get(f, 0) + 1
+            for f in log.failed_stagein():
+                self.transient[f] = self.transient.get(f, 0) + 1
+            for f, seconds in log.analyzed.iteritems():
+                self.seconds[f] = max(seconds, self.seconds.get(f, 0))
+
+
+def history(logdir, running_files=None):
+    '''
+    Returns:
+        History of logdir, only rebuilt if a log or the running jobs changed since 
+        the last call (e.g. between refreshes of task.py --monitor)
+    '''
+    logs = job_logs.parse_all(logdir)
+    running_files = set(running_files or [])
+    state = (sorted([(log.name, log.mtime) for log in logs]), running_files)
+    if logdir not in _histories or _histories[logdir][0] != state:
+        _histories[logdir] = (state, History(logdir, logs, running_files))
+    return _histories[logdir][1]
+
+
+def plan_resubmission(sample, model, target, history, max_crashes=2):
+    '''
+    Regroup the missing files of a sample:
+     - files that crashed the analyzer max_crashes times or more run alone,
+       so that they cannot take other files down with them
+     - files that only failed to stage in are packed together
+     - everything else is packed as usual
+    All groups are capped at target seconds of expected wall time.
+
+    Arguments:
+        sample {DataSample} -- missing files of one sample
+        model {dict} -- from load_model
+        target {float} -- wall time per job, in s
+        history {History} -- failures and timings of previous jobs
+    Returns:
+        list of configs, as from DataSample.get_config(N, suffix='_%i')
+    '''
+    isolated = []
+    transient = []
+    rest = []
+    for f in sample.files:
+        if history.crashes.get(f, 0) >= max_crashes:
+            isolated.append(f)
+        elif f in history.transient and f not in history.crashes:
+            transient.append(f)
+        else:
+            rest.append(f)
+    groups = [[f] for f in isolated]
+    for files in [transient, rest]:
+        costs = _file_costs(files, model, history.seconds)
+        groups += [[files[i] for i in sorted(job)] for job in pack(costs, target)]
+    return _configs(sample, groups)
@@ -1,21 +1,20 @@
-import cPickle as pickle
 from os import getenv
+from condor_status import get_status
 
 
 def query():
       r = []
-      try:
-            l = pickle.load(open(getenv('SUBMIT_WORKDIR')+'/submission.pkl'))
-            s = l[-1]
-            r.append( 'ClusterID '+str(s.cluster_id) )
-            statii = s.query_status()
-            r.append( 'Job summary:' )
-            for k,v in statii.iteritems():
-                  r.append( '\t %10s : %5i'%(k,len(v)) )
-            return r
-      except IOError:
+      l = get_status(getenv('SUBMIT_WORKDIR')).submissions()
+      if not l:
             r.append( 'No job submitted yet!' )
             return r
+      s = l[-1]
+      r.append( 'ClusterID '+str(s.cluster_id) )
+      statii = s.query_status() # answered from the cached bulk query
+      r.append( 'Job summary:' )
+      for k,v in statii.iteritems():
+            r.append( '\t %10s : %5i'%(k,len(v)) )
+      return r
 
 if __name__ == '__main__':
       print '\n'.join(query())
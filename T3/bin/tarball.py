@@ -0,0 +1,87 @@
+import os
+import hashlib
+import subprocess
+from glob import glob
+from os import path
+from multiprocessing import cpu_count
+
+from PandaCore.Tools.script import *
+
+logger = Logger('tarball.py')
+
+# the tarball is built in layers, from the least to the most frequently changing.
+# code layers are fingerprinted by name and content, library layers by name, size and mtime
+_layers = [('libs', ['biglib', 'bin', 'lib', 'objs', 'external'], False),
+           ('code', ['src', 'python', 'test'], True)]
+_vcs = set(['.git', '.svn', 'CVS', '.hg', '.bzr'])
+
+
+def _fingerprint(cmssw_base, dirs, by_content):
+    h = hashlib.md5()
+    for d in dirs:
+        for root_, subdirs, files in os.walk(path.join(cmssw_base, d), followlinks=True):
+            subdirs[:] = sorted([x for x in subdirs if x not in _vcs])
+            for f in sorted(files):
+                fpath = path.join(root_, f)
+                try:
+                    st = os.stat(fpath)
+                except OSError: # dangling symlink, tar would skip it too
+                    continue
+                if not by_content:
+                    h.update('%s %i %i\n'%(path.relpath(fpath, cmssw_base), st.st_size, st.st_mtime))
+                    continue
+                # touching a file without changing it should not rebuild the layer
+                h.update('%s %i\n'%(path.relpath(fpath, cmssw_base), st.st_size))
+                with open(fpath, 'rb') as fin:
+                    for block in iter(lambda : fin.read(1 << 20), ''):
+                        h.update(block)
+    return h.hexdigest()
+
+
+def _compressor():
+    if os.system('which pigz > /dev/null 2>&1') == 0:
+        return 'pigz -p %i'%cpu_count()
+    return 'gzip'
+
+
+def build(cmssw_base, dest):
+    '''
+    Build cmssw.tgz from its layers, only re-tarring the layers whose inputs changed.
+    The layers are concatenated gzip streams, so the result has to be unpacked
+    with tar --ignore-zeros (tar -xizf).
+
+    Arguments:
+        cmssw_base {str} -- CMSSW release area
+        dest {str} -- path of the tarball to write
+    '''
+    cachedir = path.join(cmssw_base, '.panda_tarballs')
+    if not path.isdir(cachedir):
+        os.makedirs(cachedir)
+    cwd = os.getcwd()
+    os.chdir(cmssw_base)
+    try:
+        parts = []
+        for name, dirs, by_content in _layers:
+            dirs = [d for d in dirs if path.exists(d)]
+            if not dirs:
+                continue
+            layer = path.join(cachedir, '%s_%s.tgz'%(name, _fingerprint(cmssw_base, dirs, by_content)))
+            if path.isfile(layer):
+                logger.info('Reusing %s'%layer)
+            else:
+                cmd = 'tar --exclude-vcs -ch %s | %s > %s.tmp'%(' '.join(dirs), _compressor(), layer)
+                logger.info(cmd)
+                if subprocess.call(['bash', '-o', 'pipefail', '-c', cmd]) != 0:
+                    if path.isfile(layer + '.tmp'):
+                        os.remove(layer + '.tmp')
+                    raise RuntimeError('Could not build %s'%layer)
+                os.rename(layer + '.tmp', layer)
+                # the new layer is in place, the old ones can go
+                for old in glob(path.join(cachedir, '%s_*.tgz'%name)):
+                    if old != layer:
+                        os.remove(old)
+            parts.append(layer)
+    finally:
+        os.chdir(cwd)
+    if os.system('cat %s > %s'%(' '.join(parts), dest)) != 0:
+        raise RuntimeError('Could not write %s'%dest)
@@ -8,6 +8,10 @@ import os
 from re import sub
 from glob import glob
 from query import query
+from lock_index import LockIndex
+from condor_status import get_status
+import packing
+import tarball
 from requests import post
 from urllib2 import urlopen
 from itertools import chain 
@@ -38,6 +42,7 @@ outcfg        = workdir+'/local.cfg'
 panda_cfg     = getenv('PANDA_CFG')
 
 args = parse(('--nfiles', {'type':int, 'default':-1}),
+             ('--pack_hours', {'type':float, 'default':0}),
              ('--monitor', {'type':int, 'default':0}),
              *[(x, STORE_TRUE) for x in 
                 ['--kill', '--kill_idle', '--check', '--submit', '--build_only', 
@@ -77,7 +82,14 @@ colors = {
 last_lock = 1
 last_check = 1
 
+# caches that live across refreshes of --check/--monitor
+_hashes = {}                            # catalog path -> md5
+_all_samples = {'mtime' : None,         # contents of local_all.cfg,
+                'samples' : None}       #   re-read only when it changes
+_lock_index = None                      # locks that have already been read
+
 jm.setup_schedd(getenv('SUBMIT_CONFIG'))
+status = get_status(workdir, ttl=int(getenv('SUBMIT_QUERY_TTL', 30)))
 
 def init_colors():
     curses.start_color()
@@ -90,8 +102,14 @@ def init_colors():
 ### Task-specific functions ###
 
 # for submission:
-def build_snapshot(N, modify=False):
+def build_snapshot(N, modify=False, pack_hours=0):
+    tmpl = getenv('SUBMIT_TMPL')
     if not modify:
+        if pack_hours > 0 and path.isdir(logdir):
+            # the logs of the previous run are about to go, learn from them first
+            model = packing.learn(logdir, tmpl)
+            logger.info('Throughput of %s: %.1f MB/s, %.0f s per file to stage in'%(
+                        path.basename(tmpl), model['rate'] / 1e6, model['overhead']))
         logger.info('Cleaning up staging areas...')
         rmtree(workdir); makedirs(workdir)
         rmtree(logdir); makedirs(logdir)
@@ -101,9 +119,17 @@ def build_snapshot(N, modify=False):
     logger.info('Acquiring configuration...')
     do('wget -nv -O %s/list.cfg %s'%(workdir, panda_cfg))
     fin = open(outcfg.replace('local.cfg', 'list.cfg'))
-    samples = jm.convert_catalog(list(fin), as_dict=True)
+    lines = list(fin)
+    samples = jm.convert_catalog(lines, as_dict=True)
     keys = sorted(samples)
-    to_write = [samples[k].get_config(N, suffix='_%i') for k in keys]
+    if pack_hours > 0:
+        # pack files into jobs of about pack_hours each, based on their size
+        # (or number of events, if the catalog has them)
+        model = packing.load_model(tmpl)
+        meta = packing.read_catalog_meta(lines)
+        to_write = [packing.pack_sample(samples[k], model, pack_hours * 3600, meta) for k in keys]
+    else:
+        to_write = [samples[k].get_config(N, suffix='_%i') for k in keys]
     with open(outcfg, 'w') as fout:
         for i,c in enumerate(chain.from_iterable(to_write)):
             fout.write(c%(i, i))
@@ -112,14 +138,11 @@ def build_snapshot(N, modify=False):
     do('cp -v {0}/local.cfg {0}/local_all.cfg'.format(workdir))
 
     logger.info('Tarring up CMSSW...')
-    cwd = os.getcwd()
-    os.chdir(cmssw_base)
-    do('tar --exclude-vcs -chzf cmssw.tgz src python biglib bin lib objs test external')
-    do('mv -v cmssw.tgz %s'%workdir)
+    tarball.build(cmssw_base, workdir+'/cmssw.tgz')
 
     logger.info('Creating executable...')
     os.chdir('%s/src/PandaAnalysis/T3/inputs/'%(cmssw_base))
-    do('cp -v %s %s/skim.py'%(getenv('SUBMIT_TMPL'), workdir))
+    do('cp -v %s %s/skim.py'%(tmpl, workdir))
     do('chmod 775 %s/skim.py'%(workdir))
 
     logger.info('Finalizing work area...')
@@ -149,11 +172,9 @@ def submit(silent=False):
 
 def kill(idle=False):
     if path.isfile(workdir+'/submission.pkl'): 
-        with open(workdir+'/submission.pkl','rb') as fpkl:
-            submissions = pickle.load(fpkl)
-            for s in submissions:
-                s.kill(idle_only=idle)
-            return
+        for s in status.live():
+            s.kill(idle_only=idle)
+        status.invalidate()
     else:
         logger.warning('Trying to kill a task with no submissions!')
 
@@ -178,6 +199,18 @@ def check_duplicates():
 
 
 # for monitoring:
+def md5hash(f):
+    if f not in _hashes:
+        _hashes[f] = jm.md5hash(f)
+    return _hashes[f]
+
+def read_all_samples():
+    mtime = path.getmtime(incfg)
+    if mtime != _all_samples['mtime']:
+        _all_samples['samples'] = jm.read_sample_config(incfg)
+        _all_samples['mtime'] = mtime
+    return _all_samples['samples']
+
 class Output:
     def __init__(self,name):
         self.name = name
@@ -282,18 +315,14 @@ def check(stdscr=None):
 
         processedfiles = set([])
         if jm.textlock:
-            # determine what files have been processed and logged as such
-            locks = glob(lockdir+'/*lock')
-            nl = len(locks)
-            il = 1
-            for lock in locks:
-                il += 1
-                try:
-                    flock = open(lock)
-                    for l in flock:
-                        processedfiles.add(l.strip())
-                except IOError:
-                    pass
+            # determine what files have been processed and logged as such.
+            # only locks that appeared since the last refresh are read
+            global _lock_index
+            if _lock_index is None:
+                # a one-off --check counts every lock, however fresh
+                _lock_index = LockIndex(lockdir, workdir+'/locks.db',
+                                        min_age=(30 if args.monitor else 0))
+            processedfiles = _lock_index.refresh()
         else:
             url = jm.report_server + '/condor/query?task=%s'%(submit_name)
             for r in json.load(urlopen(url)):
@@ -301,30 +330,28 @@ def check(stdscr=None):
                     processedfiles.add(r[0])
 
         # determine what samples from previous resubmissions are still running
+        # (one cached schedd query covers all of them)
         t2_samples = []
         t3_samples = []
         idle_samples = []
-        if path.isfile(workdir+'/submission.pkl'): 
-            with open(workdir+'/submission.pkl','rb') as fpkl:
-                submissions = pickle.load(fpkl)
-        else:
-            submissions = []
-        for s in submissions:
-            results = s.query_status()
+        for s, results in status.query():
             t3_samples += results['T3']
             t2_samples += results['T2']
             idle_samples += results['idle']
 
-        t2_files = list(chain.from_iterable([x.files for x in t2_samples]))
-        t3_files = list(chain.from_iterable([x.files for x in t3_samples]))
-        idle_files = list(chain.from_iterable([x.files for x in idle_samples]))
+        # file -> state of the job running it. if a file appears in several
+        # jobs, T3 takes precedence over T2, which takes precedence over idle
+        running_files = {}
+        for state, samples in [('idle', idle_samples), ('t2', t2_samples), ('t3', t3_samples)]:
+            for f in chain.from_iterable([x.files for x in samples]):
+                running_files[f] = state
 
         # for fancy display
         outputs = {}
         data = Output('Data')
         mc = Output('MC')
 
-        all_samples = jm.read_sample_config(incfg)
+        all_samples = read_all_samples()
         filtered_samples = {}
         merged_samples = {}
         outfile = open(outcfg,'w')
@@ -343,16 +370,11 @@ def check(stdscr=None):
             to_resubmit = []
 
             for f in sample.files:
-                state = 'missing'
-                hashed = f if jm.textlock else jm.md5hash(f) 
+                hashed = f if jm.textlock else md5hash(f) 
                 if hashed in processedfiles:
                     state = 'done'
-                elif f in t3_files:
-                    state = 't3'
-                elif f in t2_files:
-                    state = 't2'
-                elif f in idle_files:
-                    state = 'idle'
+                else:
+                    state = running_files.get(f, 'missing')
 
                 if state=='missing' or (args.force and state!='done'):
                     out_sample.add_file(f)
@@ -367,7 +389,19 @@ def check(stdscr=None):
             if len(out_sample.files)>0:
                 filtered_samples[name] = out_sample
 
-        if args.nfiles<0:
+        if args.pack_hours > 0:
+            # regroup what is missing based on how previous jobs went
+            history = packing.history(logdir, running_files)
+            model = packing.load_model(getenv('SUBMIT_TMPL'))
+            counter = 0
+            for k in sorted(merged_samples):
+                sample = merged_samples[k]
+                if len(sample.files)==0:
+                    continue
+                for c in packing.plan_resubmission(sample, model, args.pack_hours * 3600, history):
+                    outfile.write(c%(counter,counter))
+                    counter += 1
+        elif args.nfiles<0:
             keys = sorted(filtered_samples)
             for k in keys:
                 sample = filtered_samples[k]
@@ -496,9 +530,9 @@ if args.check:
         check()
 else:
     if (args.build_only or args.rebuild) and (not path.isfile(workdir+'/submission.pkl') or not args.submit): 
-        if args.nfiles < 0:
+        if args.nfiles < 0 and args.pack_hours <= 0:
             logger.info('Number of files not provided for new task => setting nfiles=25')
             args.nfiles = 25
-        build_snapshot(args.nfiles, modify=args.rebuild)
+        build_snapshot(args.nfiles, modify=args.rebuild, pack_hours=args.pack_hours)
     if args.submit_only:
         submit(silent=False)
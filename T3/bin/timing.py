@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+'''
+Collect the TIMING records of job_utilities.print_time, from the job logs
+and/or SUBMIT_TIMING journals, into a table, and summarize them
+'''
+
+import json
+import numpy as np
+from glob import glob
+from os import getenv, path
+from re import compile as rcompile
+
+from PandaCore.Tools.script import *
+
+_record_re = rcompile(r'TIMING (\{.*\})')
+_columns = [('job', 'S128'), ('sample', 'S128'), ('host', 'S64'), ('stage', 'S64'),
+            ('file', 'S256'), ('seconds', 'f8'), ('bytes', 'f8'), ('events', 'f8'),
+            ('time', 'f8')]
+
+
+def _records(fpath, tagged):
+    with open(fpath) as fin:
+        for l in fin:
+            if tagged:
+                m = _record_re.search(l)
+                if not m:
+                    continue
+                l = m.group(1)
+            try:
+                yield json.loads(l)
+            except ValueError: # truncated line
+                continue
+
+
+def collect(logs=(), journals=()):
+    '''
+    Arguments:
+        logs {list} -- job logs, containing TIMING lines among other output
+        journals {list} -- files of one JSON record per line
+    Returns:
+        structured numpy array with one row per record. missing numbers are NaN
+    '''
+    rows = []
+    for fpath, tagged in [(x, True) for x in logs] + [(x, False) for x in journals]:
+        for r in _records(fpath, tagged):
+            rows.append(tuple([(r.get(k) or u'').encode('utf-8') if t.startswith('S') else
+                               (np.nan if r.get(k) is None else r[k])
+                               for k, t in _columns]))
+    return np.array(rows, dtype=_columns)
+
+
+def _summarize(table, key):
+    analyze = table[table['stage'] == 'analyze']
+    staged = table[(table['stage'] == 'copy') | (table['stage'] == 'wait for data')]
+    lines = []
+    lines.append('%-40s %6s %12s %12s %12s'%(key.capitalize(), 'Files', 'Events/s', 'MB/s', 'Copy MB/s'))
+    for v in sorted(set(analyze[key])):
+        a = analyze[analyze[key] == v]
+        s = staged[staged[key] == v]
+        seconds = np.nansum(a['seconds'])
+        copy_seconds = np.nansum(s['seconds'])
+        lines.append('%-40s %6i %12.1f %12.2f %12.2f'%(
+                     v[:40], len(a),
+                     np.nansum(a['events']) / seconds if seconds else 0,
+                     np.nansum(a['bytes']) / seconds / 1e6 if seconds else 0,
+                     np.nansum(s['bytes']) / copy_seconds / 1e6 if copy_seconds else 0))
+    return lines
+
+
+def summarize(table):
+    lines = []
+    lines += _summarize(table, 'host')
+    lines.append('')
+    lines += _summarize(table, 'sample')
+    lines.append('')
+    lines.append('%-40s %12s %12s %12s'%('Stage', 'Total [h]', 'Mean [s]', 'Max [s]'))
+    stages = set(table['stage'])
+    totals = sorted([(np.nansum(table['seconds'][table['stage'] == x]), x) for x in stages],
+                    reverse=True)
+    for total, stage in totals:
+        seconds = table['seconds'][table['stage'] == stage]
+        lines.append('%-40s %12.2f %12.1f %12.1f'%(stage[:40], total / 3600,
+                                                   np.nanmean(seconds), np.nanmax(seconds)))
+    return lines
+
+
+if __name__ == '__main__':
+    args = parse(('--logdir', {'default':getenv('SUBMIT_LOGDIR')}),
+                 ('--journal', {'nargs':'+', 'default':[]}),
+                 ('--save', {'default':None}))
+    logs = glob(path.join(args.logdir, '*.err')) if args.logdir else []
+    table = collect(logs, args.journal)
+    if args.save:
+        np.save(args.save, table)
+    if len(table):
+        print '\n'.join(summarize(table))
+    else:
+        print 'No timing records found'
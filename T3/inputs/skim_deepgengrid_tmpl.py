@@ -74,27 +74,29 @@ if __name__ == "__main__":
     utils.hadd(processed.keys())
     utils.print_time('hadd')
 
-    ret = utils.stageout(outdir,outfilename)
+    to_stage = [(outfilename, 'output.root')]
     if deep_utils.STORE and False:
-        utils.stageout(outdir,outfilename.replace('.root','_arrays.root'),'arrays.root')
-    utils.cleanup('*.root')
+        to_stage.append((outfilename.replace('.root','_arrays.root'), 'arrays.root'))
     if deep_utils.SAVE:
-        if not ret:
-            data = {}
-            for f in glob('*npz'):
-                f_data = deep_utils.np.load(f)
-                for k,v in f_data.iteritems():
-                    if k not in data:
-                        data[k] = []
-                    if v.shape[0] > 0:
-                        data[k].append(v)
-            if len(data['pt']) > 0:
-                merged_data = {k : deep_utils.np.concatenate(v) for k,v in data.iteritems() if (k != 'singleton_branches')}
-                merged_data['singleton_branches'] = data['singleton_branches'][0] 
-                deep_utils.np.savez('merged_arrays.npz', **merged_data)
-                utils.print_time('merging npz')
-                ret = max(ret, utils.stageout(outdir, outfilename.replace('.root', '.npz'), 'merged_arrays.npz'))
-        utils.cleanup('*.npz')
+        data = {}
+        for f in glob('*npz'):
+            f_data = deep_utils.np.load(f)
+            for k,v in f_data.iteritems():
+                if k not in data:
+                    data[k] = []
+                if v.shape[0] > 0:
+                    data[k].append(v)
+        if len(data['pt']) > 0:
+            merged_data = {k : deep_utils.np.concatenate(v) for k,v in data.iteritems() if (k != 'singleton_branches')}
+            merged_data['singleton_branches'] = data['singleton_branches'][0] 
+            deep_utils.np.savez('merged_arrays.npz', **merged_data)
+            utils.print_time('merging npz')
+            to_stage.append((outfilename.replace('.root', '.npz'), 'merged_arrays.npz'))
+
+    # the lock is only written by report_done, after all of these succeeded
+    ret = utils.stageout_all(outdir, to_stage)
+    utils.cleanup('*.root')
+    utils.cleanup('*.npz')
     utils.print_time('stageout and cleanup')
     if not ret:
         utils.report_done(lockdir,outfilename,processed)
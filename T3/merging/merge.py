@@ -6,9 +6,12 @@ from glob import glob
 from re import sub
 from sys import argv,exit
 import sys
-from os import environ,system,path,remove
+from os import environ,system,path,remove,rename,stat,statvfs
 from argparse import ArgumentParser
+from time import sleep
 import subprocess
+import json
+import multiprocessing as mp
 from PandaCore.Tools.script import * 
 
 sname = argv[0]
@@ -16,12 +19,18 @@ args = parse(('--silent', STORE_TRUE),
              ('-cfg', {'default':'common', 'type':str}),
              ('--skip_missing', STORE_TRUE),
              ('--validate', STORE_TRUE),
+             ('--jobs', {'default':mp.cpu_count(), 'type':int}),
+             ('--single_pass', STORE_TRUE),
+             ('--incremental', STORE_TRUE),
              ('arguments', {'type':str, 'nargs':'+'}))
 
 arguments = args.arguments
 VERBOSE = not args.silent
 skip_missing = args.skip_missing
 validate = args.validate
+n_jobs = max(1, args.jobs)
+incremental = args.incremental
+single_pass = args.single_pass or incremental
 
 from PandaCore.Tools.Misc import *
 from PandaCore.Utils.load import *
@@ -103,7 +112,7 @@ def hadd(inpath,outpath):
     system(cmd+suffix)
     return True
 
-def normalizeFast(fpath,opt):
+def resolve_xsec(fpath,opt):
     xsec=-1
     if type(opt)==float or type(opt)==int:
         xsec = opt
@@ -115,76 +124,408 @@ def normalizeFast(fpath,opt):
                 if fpath in k:
                     xsec = v[2]
     if xsec<0:
+        return None
+    return xsec * xsecscale
+
+def normalizeFast(fpath,opt):
+    xsec = resolve_xsec(fpath,opt)
+    if xsec is None:
         logger.warning(sname,'could not find xsec, skipping %s!'%opt)
         return
-    xsec *= xsecscale
     logger.info(sname,'normalizing %s (%s) ...'%(fpath,opt))
     n = root.Normalizer();
     if not VERBOSE:
         n.reportFreq = 2
     n.NormalizeTree(fpath,xsec)
 
-def merge(shortnames,mergedname):
-    to_skip = []
-    for shortname in shortnames:
-        xsec = None
-        if 'monotop' in shortname:
-            pd = shortname
+def get_xsec(shortname):
+    xsec = None
+    if 'monotop' in shortname:
+        xsec = 1
+    elif 'Vector' in shortname:
+        tmp_ = shortname
+        replacements = {
+            'Vector_MonoTop_NLO_Mphi-':'',
+            '_gSM-0p25_gDM-1p0_13TeV-madgraph':'',
+            '_Mchi-':'_',
+            }
+        for k,v in replacements.iteritems():
+            tmp_ = tmp_.replace(k,v)
+        m_V,m_DM = [int(x) for x in tmp_.split('_')]
+        params = read_nr_model(m_V,m_DM)
+        if params:
+            xsec = params.sigma
+        else:
             xsec = 1
-        elif 'Vector' in shortname:
-            tmp_ = shortname
-            replacements = {
-                'Vector_MonoTop_NLO_Mphi-':'',
-                '_gSM-0p25_gDM-1p0_13TeV-madgraph':'',
-                '_Mchi-':'_',
-                }
-            for k,v in replacements.iteritems():
-                tmp_ = tmp_.replace(k,v)
-            m_V,m_DM = [int(x) for x in tmp_.split('_')]
-            params = read_nr_model(m_V,m_DM)
-            if params:
-                xsec = params.sigma
-            else:
-                xsec = 1
-        elif 'Scalar' in shortname:
-            tmp_ = shortname
-            replacements = {
-                'Scalar_MonoTop_LO_Mphi-':'',
-                '_13TeV-madgraph':'',
-                '_Mchi-':'_',
-                }
-            for k,v in replacements.iteritems():
-                tmp_ = tmp_.replace(k,v)
-            m_V,m_DM = [int(x) for x in tmp_.split('_')]
-            params = read_r_model(m_V,m_DM)
-            if params:
-                xsec = params.sigma
-            else:
-                xsec = 1
-        elif shortname in pds:
-            pd = pds[shortname][0]
-            xsec = pds[shortname][1]
+    elif 'Scalar' in shortname:
+        tmp_ = shortname
+        replacements = {
+            'Scalar_MonoTop_LO_Mphi-':'',
+            '_13TeV-madgraph':'',
+            '_Mchi-':'_',
+            }
+        for k,v in replacements.iteritems():
+            tmp_ = tmp_.replace(k,v)
+        m_V,m_DM = [int(x) for x in tmp_.split('_')]
+        params = read_r_model(m_V,m_DM)
+        if params:
+            xsec = params.sigma
         else:
-            for shortname_ in [shortname.split('_')[0],shortname.split('_')[-1]]:
-                if shortname_ in pds:
-                    pd = pds[shortname_][0]
-                    xsec = pds[shortname_][1]
-                    break
-        inpath = inbase+shortname+'_*.root'
-        success = hadd(inpath, split_dir + '%s.root'%(shortname))
-        if success:
-            normalizeFast(split_dir + '%s.root'%(shortname),xsec)
-        if not success:
-            if not skip_missing:
-                logger.error(sname, 'Could not merge %s, exiting!'%shortname)
-                exit(1)
-            else:
-                to_skip.append(shortname)
-    to_hadd = [split_dir + '%s.root'%(x) for x in shortnames if x not in to_skip]
+            xsec = 1
+    elif shortname in pds:
+        xsec = pds[shortname][1]
+    else:
+        for shortname_ in [shortname.split('_')[0],shortname.split('_')[-1]]:
+            if shortname_ in pds:
+                xsec = pds[shortname_][1]
+                break
+    return xsec
+
+def input_size(pattern):
+    return sum([path.getsize(f) for f in glob(pattern)])
+
+# pick a scratch disk that can hold the unmerged outputs of a dataset.
+# shortnames can belong to several datasets that are merged at the same time,
+# so each dataset gets its own split directory
+def scratch_dirs(pd, shortnames):
+    unmergedSize = sum([input_size(inbase+x+'_*.root') for x in shortnames])
+    if unmergedSize > 16106127360: # 15 GB
+        disk="scratch5"
+    else:
+        disk="tmp"
+    split_dir = '/%s/%s/split/%s/%s/'%(disk, user, submit_name, pd)
+    merged_dir = '/%s/%s/merged/%s/'%(disk, user, submit_name)
+    for d in [split_dir, merged_dir]:
+        system('mkdir -p ' + d)
+    return split_dir, merged_dir
+
+def free_space(d):
+    st = statvfs(d)
+    return st.f_bavail * st.f_frsize
+
+# stage 1: hadd the outputs of one shortname and normalize them
+def merge_one(shortname, split_dir):
+    outpath = split_dir + '%s.root'%(shortname)
+    if path.isfile(outpath):
+        remove(outpath) # do not pick up a stale file if this fails
+    success = hadd(inbase+shortname+'_*.root', outpath)
+    if success:
+        normalizeFast(outpath,get_xsec(shortname))
+    return success
+
+# stage 2: hadd the normalized shortnames of one dataset
+def merge_final(shortnames, mergedname, split_dir, merged_dir):
+    to_hadd = [split_dir + '%s.root'%(x) for x in shortnames]
+    to_hadd = [f for f in to_hadd if path.isfile(f)]
     hadd(to_hadd, merged_dir + '%s.root'%(mergedname))
     for f in to_hadd:
         if f.startswith('/tmp'):
             system('rm -f %s'%f)
+    if split_dir.startswith('/tmp'):
+        system('rmdir %s 2>/dev/null'%split_dir)
+    return True
+
+# stage 3: move the dataset into place
+def publish(mergedname, merged_dir):
+    merged_file = merged_dir + '%s.root'%(mergedname)
+    hadd(merged_file ,outbase) # really an mv
+    if merged_file.startswith('/tmp'):
+        system('rm -f %s'%merged_file)
+    logger.info(sname,'finished with '+mergedname)
+    return True
+
+# single-pass mode: chain every job output of a dataset and write the merged
+# tree once, with normalizedWeight = xsec * mcWeight / sum(hDTotalMCWeight)
+# already filled, instead of hadd -> NormalizeTree -> hadd
+if single_pass:
+    root.gInterpreter.Declare("""
+void panda_fill_normalized(TTree* in, TTree* out, float* weight,
+                           const std::vector<Long64_t>& bounds,
+                           const std::vector<double>& scales) {
+  TLeaf* leaf = nullptr;
+  int tree_number = -1;
+  size_t seg = 0;
+  Long64_t n = in->GetEntries();
+  for (Long64_t i = 0; i != n; ++i) {
+    in->GetEntry(i);
+    if (in->GetTreeNumber() != tree_number) {
+      tree_number = in->GetTreeNumber();
+      leaf = in->GetLeaf("mcWeight");
+    }
+    while (i >= bounds[seg])
+      ++seg;
+    *weight = scales[seg] * leaf->GetValue();
+    out->Fill();
+  }
+}
+""")
+
+def file_stat(fpath):
+    st = stat(fpath)
+    return {'size' : st.st_size, 'mtime' : st.st_mtime}
+
+# read the headers and histograms of some files, without touching the trees.
+# histograms are summed into hists, other objects are kept from the first file
+def scan_file(fpath, hists, others):
+    f = root.TFile.Open(fpath)
+    if not f or f.IsZombie():
+        logger.warning(sname, 'skipping unreadable file '+fpath) # like hadd -k
+        return None
+    finfo = file_stat(fpath)
+    finfo.update({'path' : fpath, 'trees' : {}, 'sumw' : 0})
+    seen = set([])
+    for key in f.GetListOfKeys():
+        name = key.GetName()
+        if name in seen: # older cycles of the same object
+            continue
+        seen.add(name)
+        cls = root.TClass.GetClass(key.GetClassName())
+        if cls.InheritsFrom('TTree'):
+            finfo['trees'][name] = key.ReadObj().GetEntries()
+        elif cls.InheritsFrom('TH1'):
+            h = key.ReadObj()
+            if name == 'hDTotalMCWeight':
+                finfo['sumw'] = h.Integral()
+            if name in hists:
+                hists[name].Add(h)
+            else:
+                h.SetDirectory(0)
+                hists[name] = h
+        elif name not in others:
+            # copy it while f is open, closing f deletes what it owns
+            others[name] = key.ReadObj().Clone(name)
+            if hasattr(others[name], 'SetDirectory'):
+                others[name].SetDirectory(0)
+    f.Close()
+    return finfo
+
+# write the merged file from a list of (path, {tree : entries}). weights is a
+# list of (entries, scale) covering the events tree in order, where scale
+# multiplies mcWeight, or is None if the events tree is just copied
+def write_merged(output, files, weights, hists, others):
+    chains = {}
+    n_expected = {}
+    for fpath, trees in files:
+        for name, n in trees.iteritems():
+            if name not in chains:
+                chains[name] = root.TChain(name)
+                n_expected[name] = 0
+            chains[name].AddFile(fpath, n)
+            n_expected[name] += n
+    normalize = any([x[1] is not None for x in weights])
+
+    fout = root.TFile.Open(output, 'RECREATE')
+    ret = True
+    for name, t_chain in chains.iteritems():
+        fout.cd()
+        if name == 'events' and normalize:
+            if t_chain.GetBranch('normalizedWeight'): # a previous merge, recomputed below
+                t_chain.SetBranchStatus('normalizedWeight', 0)
+            t_clone = t_chain.CloneTree(0)
+            weight = array('f', [0])
+            t_clone.Branch('normalizedWeight', weight, 'normalizedWeight/F')
+            bounds = root.std.vector('Long64_t')()
+            scales = root.std.vector('double')()
+            end = 0
+            for n, scale in weights:
+                end += n
+                bounds.push_back(end)
+                scales.push_back(scale)
+            root.panda_fill_normalized(t_chain, t_clone, weight, bounds, scales)
+        else:
+            t_clone = t_chain.CloneTree(0)
+            t_clone.CopyEntries(t_chain, -1, 'fast')
+        if t_clone.GetEntries() != n_expected[name]:
+            logger.error(sname, 'Merged %i/%i entries of %s'%(t_clone.GetEntries(),
+                                                             n_expected[name], name))
+            ret = False
+        fout.WriteTObject(t_clone, name, 'overwrite')
+    for name, obj in hists.items() + others.items():
+        fout.WriteTObject(obj, name, 'overwrite')
+    fout.Close()
+    return ret
+
+# the manifest records which job outputs went into a merged dataset, and in
+# which order, so that later merges only need to read the new ones
+def manifest_path(mergedname):
+    return path.join(outbase, '.merge', '%s.json'%mergedname)
+
+def load_manifest(shortnames, mergedname, output):
+    try:
+        with open(manifest_path(mergedname)) as fmanifest:
+            manifest = json.load(fmanifest)
+    except (IOError, ValueError):
+        return None
+    if not path.isfile(output) or manifest['output'] != file_stat(output):
+        logger.info(sname, '%s changed since the last merge'%output)
+        return None
+    if sorted(manifest['shortnames']) != sorted(shortnames):
+        return None
+    for shortname, info in manifest['shortnames'].iteritems():
+        for fpath, finfo in info['files'].iteritems():
+            if not path.isfile(fpath) or file_stat(fpath) != {'size' : finfo['size'], 
+                                                               'mtime' : finfo['mtime']}:
+                logger.info(sname, '%s changed since the last merge'%fpath)
+                return None
+    return manifest
+
+def write_manifest(mergedname, output, shortname_infos, segments):
+    manifest = {'output' : file_stat(output),
+                'shortnames' : shortname_infos,
+                'segments' : segments}
+    mpath = manifest_path(mergedname)
+    system('mkdir -p ' + path.dirname(mpath))
+    with open(mpath + '.tmp', 'w') as fmanifest:
+        json.dump(manifest, fmanifest)
+    rename(mpath + '.tmp', mpath)
+
+# add a run of entries from one shortname to the list of segments
+def add_segment(segments, shortname, n):
+    if segments and segments[-1][0] == shortname:
+        segments[-1][1] += n
+    else:
+        segments.append([shortname, n])
+
+def merge_single_pass(shortnames, mergedname):
+    output = path.join(outbase, '%s.root'%mergedname)
+    manifest = load_manifest(shortnames, mergedname, output) if incremental else None
+    if manifest:
+        infos = manifest['shortnames']
+        segments = manifest['segments']
+    else:
+        infos = {x : {'files' : {}, 'sumw' : 0} for x in shortnames}
+        segments = []
+
+    hists = {}
+    others = {}
+    new_files = []
+    for shortname in shortnames:
+        info = infos[shortname]
+        for fpath in sorted(glob(inbase+shortname+'_*.root')):
+            if fpath in info['files']:
+                continue
+            finfo = scan_file(fpath, hists, others)
+            if finfo is None:
+                continue
+            info['files'][fpath] = {k : finfo[k] for k in ['size', 'mtime', 'sumw']}
+            info['files'][fpath]['entries'] = finfo['trees'].get('events', 0)
+            info['sumw'] += finfo['sumw']
+            new_files.append((shortname, finfo))
+        if not info['files']:
+            if skip_missing:
+                logger.warning(sname, 'Could not merge %s, skipping'%shortname)
+                continue
+            logger.error(sname, 'Could not merge %s, exiting!'%shortname)
+            return False
+    if manifest and not new_files:
+        logger.info(sname, 'nothing new to merge into '+mergedname)
+        return True
+    if not new_files and not segments:
+        logger.warning(sname,'nothing merged into '+mergedname)
+        return True
+
+    scales = {}
+    for shortname in shortnames:
+        info = infos[shortname]
+        info['xsec'] = resolve_xsec(shortname, get_xsec(shortname))
+        if not info['files']:
+            continue
+        if info['xsec'] is None:
+            logger.warning(sname,'could not find xsec, skipping %s!'%shortname)
+            scales[shortname] = None
+        elif info['sumw'] <= 0:
+            logger.error(sname,'no hDTotalMCWeight to normalize %s'%shortname)
+            return False
+        else:
+            logger.info(sname,'normalizing %s (%s) ...'%(shortname, info['xsec']))
+            scales[shortname] = info['xsec'] / info['sumw']
+    if len(set([x is not None for x in scales.itervalues()])) > 1:
+        logger.error(sname, '%s mixes samples with and without a xsec'%mergedname)
+        return False
+
+    files = []
+    if manifest:
+        # the previous output goes first, its normalizedWeight is recomputed
+        # from mcWeight with the updated sums of weights
+        logger.info(sname,'appending %i new files to %s'%(len(new_files), output))
+        old = scan_file(output, hists, others)
+        files.append((output, old['trees']))
+    else:
+        logger.info(sname,'merging %i files into %s'%(len(new_files), output))
+    for shortname, finfo in new_files:
+        files.append((finfo['path'], finfo['trees']))
+        add_segment(segments, shortname, finfo['trees'].get('events', 0))
+    weights = [(n, scales[shortname]) for shortname, n in segments]
+
+    tmp = output.replace('.root', '.tmp.root')
+    if not write_merged(tmp, files, weights, hists, others):
+        remove(tmp)
+        return False
+    rename(tmp, output)
+    write_manifest(mergedname, output, infos, segments)
+    logger.info(sname,'finished with '+mergedname)
+    return True
+
+
+class Task(object):
+    def __init__(self, name, fn, args, deps=None, disk=0, scratch=None, optional=False):
+        '''
+        Arguments:
+            name {str} -- label for logging
+            fn {function} -- work to do in a child process, returning False on failure
+            args {tuple} -- arguments to fn
+            deps {list} -- Tasks that have to finish first
+            disk {int} -- bytes of scratch space the task will write
+            scratch {str} -- directory the task writes into
+            optional {bool} -- if True, a failure does not stop the other tasks
+        '''
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.deps = deps or []
+        self.disk = disk
+        self.scratch = scratch
+        self.optional = optional
+        self.proc = None
+
+def _run_task(fn, args):
+    exit(0 if fn(*args) is not False else 1)
+
+# run a DAG of tasks, at most n_jobs at a time, only starting a task if the
+# scratch disk has room for what it will write on top of what is in flight
+def run_tasks(tasks, n_jobs):
+    pending = list(tasks)
+    running = []
+    done = set()
+    while pending or running:
+        for t in running[:]:
+            if t.proc.is_alive():
+                continue
+            running.remove(t)
+            if t.proc.exitcode:
+                if t.optional and skip_missing:
+                    logger.warning(sname, 'Could not merge %s, skipping'%t.name)
+                else:
+                    logger.error(sname, 'Could not merge %s, exiting!'%t.name)
+                    for other in running:
+                        other.proc.terminate()
+                    exit(1)
+            done.add(t)
+        for t in pending[:]:
+            if len(running) >= n_jobs:
+                break
+            if any([d not in done for d in t.deps]):
+                continue
+            if t.scratch and running:
+                in_flight = sum([x.disk for x in running if x.scratch == t.scratch])
+                if t.disk + in_flight > free_space(t.scratch):
+                    continue
+            pending.remove(t)
+            logger.info(sname, 'starting '+t.name)
+            t.proc = mp.Process(target=_run_task, args=(t.fn, t.args))
+            t.proc.start()
+            running.append(t)
+        sleep(0.5)
 
 
 args = {}
@@ -195,23 +536,22 @@ for pd in arguments:
     else:
         args[pd] = [pd]
 
+tasks = []
 for pd in args:
-    unmergedFiles = glob("{0}/{1}_*.root".format(environ['SUBMIT_OUTDIR'],pd))
-    unmergedSize = 0
-    for unmergedFile in unmergedFiles:
-        unmergedSize += path.getsize(unmergedFile)
-    if unmergedSize > 16106127360: # 15 GB
-        disk="scratch5"
-    else:
-        disk="tmp"
-    split_dir = '/%s/%s/split/%s/'%(disk, user, submit_name)
-    merged_dir = '/%s/%s/merged/%s/'%(disk, user, submit_name)
-    for d in [split_dir, merged_dir]:
-        system('mkdir -p ' + d)
-    merge(args[pd],pd)
-    merged_file = merged_dir + '%s.root'%(pd)
-    hadd(merged_file ,outbase) # really an mv
-    if merged_file.startswith('/tmp'):
-        system('rm -f %s'%merged_file)
-    logger.info(sname,'finished with '+pd)
+    if single_pass:
+        # no intermediate copies, so no scratch disk to choose
+        tasks.append(Task(pd, merge_single_pass, (args[pd], pd)))
+        continue
+    split_dir, merged_dir = scratch_dirs(pd, args[pd])
+    splits = []
+    for shortname in args[pd]:
+        splits.append(Task(shortname, merge_one, (shortname, split_dir), 
+                           disk=input_size(inbase+shortname+'_*.root'), 
+                           scratch=split_dir, optional=True))
+    final = Task(pd, merge_final, (args[pd], pd, split_dir, merged_dir), 
+                 deps=splits, disk=sum([x.disk for x in splits]), scratch=merged_dir)
+    tasks += splits
+    tasks.append(final)
+    tasks.append(Task(pd+' -> '+outbase, publish, (pd, merged_dir), deps=[final]))
 
+run_tasks(tasks, n_jobs)
@@ -0,0 +1,142 @@
+'''PandaAnalysis.T3.input_cache
+
+Node-level cache of staged-in input files, shared by all jobs on a worker
+'''
+
+import os
+import fcntl
+import shutil
+from os import path, getpid
+from glob import glob
+
+from PandaCore.Utils.logging import logger
+
+_sname = 'T3.input_cache'
+
+
+class InputCache(object):
+    def __init__(self, cachedir, max_bytes):
+        '''
+        Arguments:
+            cachedir {str} -- directory shared by all jobs on this node
+            max_bytes {float} -- size above which least-recently-used files are evicted
+        '''
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.bytes_copied = 0
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            pass # already exists, possibly made by another job
+
+    # lock files of evicted keys are removed, so after getting the lock we make
+    # sure that it is still the file at that path, and not a removed one
+    def _lock(self, name, block=True):
+        lpath = path.join(self.cachedir, name + '.lock')
+        while True:
+            flock = open(lpath, 'a')
+            try:
+                fcntl.flock(flock, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+            except IOError: # held by someone else
+                flock.close()
+                return None
+            try:
+                if os.stat(lpath).st_ino == os.fstat(flock.fileno()).st_ino:
+                    return flock
+            except OSError:
+                pass
+            self._unlock(flock)
+
+    def _unlock(self, flock):
+        fcntl.flock(flock, fcntl.LOCK_UN)
+        flock.close()
+
+    # evict least-recently-used files until there is room for `needed` bytes.
+    # files that are hard-linked into a running job, or that a job is about to
+    # link (it holds the key's lock), are never evicted
+    def _make_room(self, needed):
+        flock = self._lock('index')
+        try:
+            cached = []
+            for f in glob(path.join(self.cachedir, '*.root')):
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                cached.append((st.st_mtime, st.st_size, st.st_nlink, f))
+            used = sum([x[1] for x in cached])
+            for mtime, size, nlink, f in sorted(cached):
+                if used + needed <= self.max_bytes:
+                    break
+                if nlink > 1:
+                    continue
+                key = path.basename(f)[:-len('.root')]
+                fkey = self._lock(key, block=False)
+                if fkey is None:
+                    continue
+                try:
+                    logger.info(_sname+'.evict', f)
+                    os.remove(f)
+                    os.remove(path.join(self.cachedir, key + '.lock'))
+                    used -= size
+                except OSError as e:
+                    logger.warning(_sname+'.evict', str(e))
+                finally:
+                    self._unlock(fkey)
+        finally:
+            self._unlock(flock)
+
+    def fetch(self, key, dest, copy, size=None):
+        '''
+        Arguments:
+            key {str} -- identifies the file contents
+            dest {str} -- where the job expects the file
+            copy {function} -- copy(tmp_path) should stage the file to tmp_path, returning success
+            size {int} -- expected size in bytes, if known
+        Returns:
+            dest if the file could be provided, else None
+        '''
+        cached = path.join(self.cachedir, key + '.root')
+        # one job downloads a given file, the others wait for it
+        flock = self._lock(key)
+        try:
+            if path.isfile(cached) and (size is None or path.getsize(cached) == size):
+                self.hits += 1
+                self.bytes_hit += path.getsize(cached)
+                os.utime(cached, None) # mtime is the LRU stamp
+                logger.info(_sname+'.fetch', 'Cache hit for %s'%key)
+            else:
+                self.misses += 1
+                tmp = cached + '.%i.tmp'%getpid()
+                if not copy(tmp) or not path.isfile(tmp):
+                    if path.isfile(tmp):
+                        os.remove(tmp)
+                    return None
+                if size is not None and path.getsize(tmp) != size:
+                    logger.warning(_sname+'.fetch',
+                                   'Expected %i bytes for %s, got %i'%(size, key, path.getsize(tmp)))
+                    os.remove(tmp)
+                    return None
+                self.bytes_copied += path.getsize(tmp)
+                self._make_room(path.getsize(tmp))
+                os.rename(tmp, cached)
+                logger.info(_sname+'.fetch', 'Cache miss for %s'%key)
+            if path.isfile(dest):
+                os.remove(dest)
+            try:
+                os.link(cached, dest)
+            except OSError: # e.g. cache on a different filesystem
+                shutil.copy(cached, dest)
+            return dest
+        finally:
+            self._unlock(flock)
+
+    def report(self):
+        logger.info(_sname+'.report',
+                    '%i hits (%.1f MB), %i misses (%.1f MB copied)'%(self.hits,
+                                                                    self.bytes_hit / 1e6,
+                                                                    self.misses,
+                                                                    self.bytes_copied / 1e6))
@@ -2,11 +2,17 @@
 
 import os
 import json
+import zlib
 import socket
 import requests
+import shutil
+import multiprocessing as mp
+from Queue import Empty
 from re import sub
 from glob import glob 
+from itertools import chain
 from random import choice
+from multiprocessing.pool import ThreadPool
 from sys import exit, argv
 from time import clock, time, sleep
 from os import system, getenv, path, environ, getpid
@@ -16,6 +22,8 @@ from PandaCore.Utils.load import Load
 from PandaCore.Utils.root import root 
 import PandaCore.Tools.job_config as cb
 import PandaAnalysis.Tagging.cfg_v8 as tagcfg
+from PandaAnalysis.T3.input_cache import InputCache
+from PandaAnalysis.T3.reporting import Reporter
 
 _sname = 'T3.job_utilities'                                      # name of this module
 _data_dir = getenv('CMSSW_BASE') + '/src/PandaAnalysis/data/'    # data directory
@@ -26,10 +34,26 @@ local_copy = bool(environ.get('SUBMIT_LOCALACCESS', True))       # should we alw
 _task_name = getenv('SUBMIT_NAME')                               # name of this task
 _user = getenv('SUBMIT_USER')                                    # user running the task
 _job_id = None                                                   # identifying string for this job
+_job_name = None                                                 # name of this job's output
+_sample = None                                                   # sample this job is running on
+_timing_journal = getenv('SUBMIT_TIMING')                        # where to append timing records, if anywhere
 _year = 2016                                                     # what year's data is this analysis?
 maxcopy = 3                                                      # maximum number of stagein attempts
+_prefetch_depth = int(getenv('SUBMIT_PREFETCH', 0))              # how many files to stage in ahead of the analyzer
+_prefetch_budget = float(getenv('SUBMIT_PREFETCH_GB', 20)) * 1e9 # local disk that prefetched inputs may occupy
+_nproc = int(getenv('SUBMIT_NPROC', 1))                          # how many files to skim in parallel, capped at the slot size
+_max_private = 100e6                                             # larger files of the job directory are hard-linked into parallel children
 _to_hdfs = bool(getenv('SUBMIT_HDFSCACHE', False))               # should we cache on hdfs instead of local
 _users = ['snarayan', 'bmaier', 'dhsu', 'ceballos']              # MIT T3 PandaAnalysis users 
+_reporter = None                                                 # sends reports to cb.report_server
+_journal = getenv('SUBMIT_REPORTJOURNAL',                        # where undelivered reports are kept, 
+                  '/tmp/%s_panda_reports'%getenv('USER', 'condor')) #   on the node, not in the job's scratch
+_fast_stageout = bool(getenv('SUBMIT_FASTSTAGEOUT', False))      # verify stageout by checksum/size, not by copying back
+_stageout_rate = float(getenv('SUBMIT_STAGEOUT_MBPS', 5)) * 1e6  # slowest transfer rate we wait for, in B/s
+_input_cache = None                                              # node-level cache of xrdcopied inputs
+if getenv('SUBMIT_NODECACHE'):
+    _input_cache = InputCache(getenv('SUBMIT_NODECACHE'), 
+                              float(getenv('SUBMIT_NODECACHE_GB', 50)) * 1e9)
 
 stageout_protocol = None                                         # what stageout should we use?
 if _is_t3:
@@ -69,15 +93,51 @@ _gsiftp_doors = [
 
 
 
-# global to keep track of how long things take
+# global to keep track of how long things take.
+# besides the log line, a TIMING record is logged (and appended to 
+# the SUBMIT_TIMING journal, if set) for T3/bin/timing.py to collect
 _stopwatch = time() 
-def print_time(label):
+def print_time(label, f=None, nbytes=None, events=None):
     global _stopwatch
     now_ = time()
-    logger.debug(_sname+'.print_time:', 
-           '%.1f s elapsed performing "%s"'%((now_-_stopwatch), label))
+    text = label if f is None else '%s %s'%(label, f)
+    logger.info(_sname+'.print_time:', 
+           '%.1f s elapsed performing "%s"'%((now_-_stopwatch), text))
+    record = {'job' : _job_name or str(getpid()),
+              'sample' : _sample,
+              'host' : _host,
+              'stage' : label,
+              'file' : f,
+              'seconds' : now_ - _stopwatch,
+              'bytes' : nbytes,
+              'events' : events,
+              'time' : now_}
+    logger.info(_sname+'.print_time:', 'TIMING ' + json.dumps(record))
+    if _timing_journal:
+        try:
+            with open(_timing_journal, 'a') as fjournal:
+                fjournal.write(json.dumps(record) + '\n')
+        except IOError as e:
+            logger.warning(_sname+'.print_time', str(e))
     _stopwatch = now_
 
+
+def _n_bytes(input_name):
+    try:
+        return path.getsize(input_name)
+    except (OSError, TypeError):
+        return None
+
+
+def _n_events(input_name):
+    f = root.TFile.Open(input_name)
+    if not f or f.IsZombie():
+        return None
+    t = f.Get('events')
+    n = t.GetEntries() if t else None
+    f.Close()
+    return n
+
 # set the data-taking period
 def set_year(analysis, year):
     global _year
@@ -140,16 +200,11 @@ def request_data(xrd_path, first_attempt):
                     # tell server we're using this file
                     payload = {'path' : local_user_path, 
                                'bytes' : path.getsize(local_user_path)}
-                    r = requests.post(cb.report_server+'/condor/requestdata', json=payload)
-                    if r.status_code == 200:
-                        logger.info(_sname+'.request_data', 'return=%s'%(str(r).strip()))
-                    else:
-                        logger.warning(_sname+'.request_data', 'return=%s'%(str(r).strip()))
+                    _report('/condor/requestdata', payload)
                     logger.info(_sname+'.request_data', 'Using local user file %s'%local_path)
                     return local_user_path
 
     # ok now we have to copy the data in:
-    xrdargs = ['xrdcopy', '--nopbar', '-f', xrd_path]
     cache = _is_t3 and _to_hdfs
     if cache:
         input_path = local_path.replace('paus', _user) 
@@ -161,23 +216,121 @@ def request_data(xrd_path, first_attempt):
             except OSError as e:
                 logger.warning(_sname+'.request_data', str(e))
                 pass 
-    xrdargs.append(input_path)
-    xrdargs = ' '.join(xrdargs)
-    logger.info(_sname+'.request_data', xrdargs)
-    ret = system(xrdargs)
+    elif _input_cache is not None:
+        size = _remote_size(xrd_path)
+        key = '%s_%s_%s'%(panda_id, cb.md5hash(xrd_path), size)
+        input_path = _input_cache.fetch(key, input_path, 
+                                        lambda tmp : _xrdcopy(xrd_path, tmp) == 0, 
+                                        size)
+        if input_path and _validate_file(input_path):
+            return input_path
+        return None
+    ret = _xrdcopy(xrd_path, input_path)
     if ret:
-        logger.error(_sname+'.request_data', 'Failed to xrdcopy %s'%input_path)
         return None 
     if _validate_file(input_path):
         if cache:
             payload = {'path' : input_path, 
                        'bytes' : path.getsize(input_path)}
-            r = requests.post(cb.report_server+'/condor/requestdata', json=payload)
+            _report('/condor/requestdata', payload)
         logger.info(_sname+'.request_data', 'Successfully xrdcopied %s'%input_path)
         return input_path
     return None 
 
 
+def _xrdcopy(xrd_path, input_path):
+    xrdargs = ' '.join(['xrdcopy', '--nopbar', '-f', xrd_path, input_path])
+    logger.info(_sname+'.request_data', xrdargs)
+    ret = system(xrdargs)
+    if ret:
+        logger.error(_sname+'.request_data', 'Failed to xrdcopy %s'%input_path)
+    return ret
+
+
+# size of a remote file, or None if the server can't tell us
+def _remote_size(xrd_path):
+    server, lfn = xrd_path.replace('root://', '').split('/', 1)
+    for l in os.popen('xrdfs %s stat /%s 2>/dev/null'%(server, lfn.lstrip('/'))):
+        if l.startswith('Size:'):
+            return int(l.split()[-1])
+    return None
+
+
+# request a file, retrying up to maxcopy times
+def stage_in(xrd_path):
+    input_name = None
+    for i_attempt in xrange(maxcopy):
+        input_name = request_data(xrd_path, i_attempt==0)
+        if input_name is not None:
+            break
+        sleep(30)
+    if input_name is None:
+        # T3/bin/job_logs.py picks this up to plan resubmissions
+        logger.error(_sname+'.stage_in', 'Could not stage in %s'%xrd_path)
+    return input_name
+
+
+# disk space taken up by a staged input, if it is a local copy
+def _local_size(input_name):
+    if input_name and input_name[:5] == 'input' and path.isfile(input_name):
+        return path.getsize(input_name)
+    return 0
+
+
+# runs in a separate process, so transfers are not blocked 
+# by the analyzer holding the interpreter
+def _prefetch(files, staged, released, depth, budget):
+    n_ahead = 0
+    used = 0
+    for f in files:
+        # n_ahead includes the file currently being analyzed
+        while n_ahead > depth or (n_ahead > 0 and used >= budget):
+            used -= released.get()
+            n_ahead -= 1
+        try:
+            input_name = stage_in(f)
+            size = _local_size(input_name)
+        except Exception as e:
+            # hand the failure back, the job carries on with the next file
+            logger.error(_sname+'.prefetch', 'Could not stage in %s (%s)'%(f, str(e)))
+            input_name, size = None, 0
+        n_ahead += 1
+        used += size
+        staged.put((f, input_name, size))
+    if _input_cache is not None:
+        _input_cache.report()
+    flush_reports(60)
+
+
+# stages in files N+1..N+depth while file N is being analyzed
+class Prefetcher(object):
+    def __init__(self, files, depth=None, budget=None):
+        self.files = files
+        self._staged = mp.Queue()
+        self._released = mp.Queue()
+        self._worker = mp.Process(target=_prefetch, 
+                                  args=(files, self._staged, self._released, 
+                                        depth or _prefetch_depth, 
+                                        budget or _prefetch_budget))
+        self._worker.daemon = True
+        self._worker.start()
+    def __iter__(self):
+        for _ in self.files:
+            while True:
+                try:
+                    yield self._staged.get(timeout=60)
+                    break
+                except Empty:
+                    # the worker can only die without delivering if it crashed
+                    if not self._worker.is_alive() and self._staged.empty():
+                        raise RuntimeError('Prefetching exited with code %s'%
+                                           str(self._worker.exitcode))
+    def release(self, size):
+        self._released.put(size)
+    def join(self):
+        self._worker.join()
+
+
 # wrapper around remove. be careful!
 def cleanup(fname, _verbose=True):
     if path.isfile(fname):
@@ -192,16 +345,16 @@ def cleanup(fname, _verbose=True):
     return 0 # if it made it this far without OSError, it's good
 
 
-# wrapper around hadd
+# merge the outputs of good_inputs into output, as hadd -f would, 
+# but in-process (see merge_outputs)
 def hadd(good_inputs, output='output.root'):
-    good_outputs = ' '.join([input_to_output(x) for x in good_inputs])
-    cmd = 'hadd -f ' + output + ' ' + good_outputs
-    logger.info(_sname+'.hadd', cmd)
-    ret = system(cmd)    
+    logger.info(_sname+'.hadd', 'Merging %i outputs into %s'%(len(good_inputs), output))
+    ret = merge_outputs(good_inputs, output)
     if not ret:
         logger.info(_sname+'.hadd', 'Merging exited with code %i'%ret)
     else:
         logger.error(_sname+'.hadd', 'Merging exited with code %i'%ret)
+    return ret
 
 
 # remove any irrelevant branches from the final tree.
@@ -218,19 +371,7 @@ def drop_branches(to_drop=None, to_keep=None):
     f = root.TFile('output.root', 'UPDATE')
     t = f.FindObjectAny('events')
     n_entries = t.GetEntriesFast() # to check the file wasn't corrupted
-    if to_drop:
-        if type(to_drop)==str:
-            t.SetBranchStatus(to_drop, False)
-        else:
-            for b in to_drop:
-                t.SetBranchStatus(b, False)
-    elif to_keep:
-        t.SetBranchStatus('*', False)
-        if type(to_keep)==str:
-            t.SetBranchStatus(to_keep, True)
-        else:
-            for b in to_keep:
-                t.SetBranchStatus(b, True)
+    _select_branches(t, to_drop, to_keep)
     t_clone = t.CloneTree()
     f.WriteTObject(t_clone, 'events', 'overwrite')
     f.Close()
@@ -249,6 +390,91 @@ def drop_branches(to_drop=None, to_keep=None):
 
 
 
+# apply a to_drop/to_keep branch selection to a tree
+def _select_branches(t, to_drop=None, to_keep=None):
+    if to_drop:
+        if type(to_drop)==str:
+            to_drop = [to_drop]
+        for b in to_drop:
+            t.SetBranchStatus(b, False)
+    elif to_keep:
+        if type(to_keep)==str:
+            to_keep = [to_keep]
+        t.SetBranchStatus('*', False)
+        for b in to_keep:
+            t.SetBranchStatus(b, True)
+
+
+# in-process replacement for hadd + drop_branches + record_inputs.
+# trees are concatenated with the branch selection applied, histograms
+# are summed, and anything else is taken from the first input. the
+# number of entries is checked against the input headers, so the 
+# output does not have to be reopened
+def merge_outputs(good_inputs, output='output.root', 
+                  to_drop=None, to_keep=None, processed=None):
+    if to_drop and to_keep:
+        logger.error(_sname+'.merge_outputs', 'Can only provide to_drop OR to_keep')
+        return 1
+
+    chains = {}
+    n_expected = {}
+    hists = {}
+    others = {}
+    for fpath in [input_to_output(x) for x in good_inputs]:
+        f = root.TFile.Open(fpath)
+        if not f or f.IsZombie():
+            logger.error(_sname+'.merge_outputs', 'Could not open '+fpath)
+            return 1
+        seen = set([])
+        for key in f.GetListOfKeys():
+            name = key.GetName()
+            if name in seen: # older cycles of the same object
+                continue
+            seen.add(name)
+            cls = root.TClass.GetClass(key.GetClassName())
+            if cls.InheritsFrom('TTree'):
+                if name not in chains:
+                    chains[name] = root.TChain(name)
+                    n_expected[name] = 0
+                chains[name].AddFile(fpath)
+                n_expected[name] += key.ReadObj().GetEntries() # only reads the header
+            elif cls.InheritsFrom('TH1'):
+                h = key.ReadObj()
+                if name in hists:
+                    hists[name].Add(h)
+                else:
+                    h.SetDirectory(0)
+                    hists[name] = h
+            elif name not in others:
+                # copy it while f is open, closing f deletes what it owns
+                others[name] = key.ReadObj().Clone(name)
+                if hasattr(others[name], 'SetDirectory'):
+                    others[name].SetDirectory(0)
+        f.Close()
+
+    fout = root.TFile.Open(output, 'RECREATE')
+    ret = 0
+    for name, t_chain in chains.iteritems():
+        _select_branches(t_chain, to_drop, to_keep)
+        fout.cd()
+        t_clone = t_chain.CloneTree(0)
+        t_clone.CopyEntries(t_chain, -1, 'fast')
+        if t_clone.GetEntries() != n_expected[name]:
+            logger.error(_sname+'.merge_outputs', 
+                         'Merged %i/%i entries of %s'%(t_clone.GetEntries(), 
+                                                       n_expected[name], name))
+            ret = 2
+        fout.WriteTObject(t_clone, name, 'overwrite')
+    for name, obj in chain(hists.iteritems(), others.iteritems()):
+        fout.WriteTObject(obj, name, 'overwrite')
+    if processed is not None:
+        fout.WriteTObject(root.TNamed('record', ', '.join(processed.values())))
+    fout.Close()
+    logger.info(_sname+'.merge_outputs', 
+                'Merged %i files into %s'%(len(good_inputs), output))
+    return ret
+
+
 # stageout a file (e.g. output or lock)
 #  - if _is_t3, execute a simple cp
 #  - else, use lcg-cp
@@ -261,8 +487,11 @@ def stageout(outdir, outfilename, infilename='output.root', n_attempts=10):
         logger.error(_sname+'.stageout', 
                'Stageout protocol has not been satisfactorily determined! Cannot proceed.')
         return -2
+    if _fast_stageout and stageout_protocol in ('cp', 'gfal'):
+        return _stageout_verified(outdir, outfilename, infilename, n_attempts)
     timeout = 300
     ret = -1
+    testfile = 'testfile_' + path.basename(outfilename) # one per output, stageout_all runs them at once
     for i_attempt in xrange(n_attempts):
 #        door = choice(gsiftp_doors); gsiftp_doors.remove(door)
         door = gsiftp_doors[0]
@@ -272,7 +501,7 @@ def stageout(outdir, outfilename, infilename='output.root', n_attempts=10):
                       '-v', 
                       '$PWD/%s'%infilename, 
                       '%s/%s'%(outdir, outfilename)]
-            lsargs = ['cp', cpargs[-1], '$PWD/testfile']
+            lsargs = ['cp', cpargs[-1], '$PWD/'+testfile]
             rmargs = ['rm', cpargs[-1]]
         elif stageout_protocol == 'gfal':
             cpargs = ['gfal-copy', 
@@ -310,18 +539,112 @@ def stageout(outdir, outfilename, infilename='output.root', n_attempts=10):
                 failed = True
         if not failed:
             logger.info(_sname+'.stageout', 'Copy succeeded after %i attempts'%(i_attempt+1))
-            cleanup('testfile')
+            cleanup(testfile)
             return ret
         else:
             system(rmargs)
             timeout = int(timeout * 1.5)
-        cleanup('testfile')
+        cleanup(testfile)
     logger.error(_sname+'.stagoeut', 'Copy failed after %i attempts'%(n_attempts))
     return ret
 
+# copy src to dst, computing the adler32 of what was written on the way
+def _copy_adler32(src, dst, blocksize=16*1024*1024):
+    checksum = 1
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            while True:
+                block = fin.read(blocksize)
+                if not block:
+                    break
+                checksum = zlib.adler32(block, checksum)
+                fout.write(block)
+            fout.flush()
+            os.fsync(fout.fileno())
+    return checksum & 0xffffffff
+
+
+# stageout without the sleep and without reading the output back:
+#  - cp: checksum while writing, then compare the size the destination reports
+#  - gfal: let gfal-copy compare source and destination adler32
+# the transfer timeout scales with the file size
+def _stageout_verified(outdir, outfilename, infilename, n_attempts):
+    src = path.abspath(infilename)
+    size = path.getsize(src)
+    timeout = max(300, int(size / _stageout_rate))
+    ret = -1
+    for i_attempt in xrange(n_attempts):
+        if stageout_protocol == 'cp':
+            dst = '%s/%s'%(outdir, outfilename)
+            logger.info(_sname+'.stageout', 'cp %s %s'%(src, dst))
+            try:
+                checksum = _copy_adler32(src, dst)
+                dst_size = os.stat(dst).st_size
+                if dst_size == size:
+                    ret = 0
+                else:
+                    logger.warning(_sname+'.stageout', 
+                                   'Wrote %i bytes, destination has %i'%(size, dst_size))
+                    ret = 1
+            except (IOError, OSError) as e:
+                logger.warning(_sname+'.stageout', str(e))
+                ret = 1
+            if not ret:
+                logger.info(_sname+'.stageout', 'adler32=%08x'%checksum)
+            else:
+                cleanup(dst)
+        else:
+            dst = 'gsiftp://%s:2811//%s/%s'%(_gsiftp_doors[0], outdir, outfilename)
+            cpargs = ' '.join(['gfal-copy', 
+                               '-f', 
+                               '-K adler32', 
+                               '--transfer-timeout %i'%timeout, 
+                               'file://'+src, 
+                               dst])
+            logger.info(_sname+'.stageout', cpargs)
+            ret = system(cpargs)
+            if ret:
+                logger.warning(_sname+'.stageout', 'Move exited with code %i'%ret)
+                system('gfal-rm '+dst)
+                timeout = int(timeout * 1.5)
+        if not ret:
+            logger.info(_sname+'.stageout', 'Copy succeeded after %i attempts'%(i_attempt+1))
+            return ret
+    logger.error(_sname+'.stageout', 'Copy failed after %i attempts'%(n_attempts))
+    return ret
+
+
+# stageout several files at once, e.g. the root and npz outputs of a job.
+# takes a list of (outfilename, infilename) and returns the first failed return code.
+# lock files should still be staged out after this, once everything is there
+def stageout_all(outdir, files, n_attempts=10):
+    pool = ThreadPool(len(files))
+    try:
+        rets = pool.map(lambda x : stageout(outdir, x[0], x[1], n_attempts), files)
+    finally:
+        pool.close()
+    return next((r for r in rets if r), 0)
+
+
+# queue a report for the server without waiting for it
+def _report(endpoint, payload):
+    global _reporter
+    if _reporter is None:
+        _reporter = Reporter(cb.report_server, _journal)
+    _reporter.post(endpoint, payload)
+
+
+# give queued reports a chance to go out before this process exits
+def flush_reports(timeout=None):
+    if _reporter is not None:
+        return _reporter.flush(timeout)
+    return True
+
+
 # report home that the job has started
 def report_start(outdir, outfilename, args):
-    global _job_id
+    global _job_id, _job_name
+    _job_name = outfilename.replace('.root', '')
     if not cb.textlock:
         _job_id = '_'.join(outfilename.replace('.root', '').split('_')[-2:]) + '_' + str(int(time()))
         hashed = [cb.md5hash(x) for x in args]
@@ -330,19 +653,7 @@ def report_start(outdir, outfilename, args):
                    'task' : _task_name + '_' + _user, 
                    'job_id' : _job_id, 
                    'args' : hashed}
-        for _ in xrange(5):
-            try:
-                r = requests.post(cb.report_server+'/condor/start', json=payload)
-                if r.status_code == 200:
-                    logger.info('T3.job_utilities.report_start', 'return=%s'%(str(r).strip()))
-                    return 
-                else:
-                    logger.error('T3.job_utilities.report_start', 'return=%s'%(str(r).strip()))
-                sleep(10)
-            except requests.ConnectionError as e:
-                logger.error('T3.job_utilities.report_start', str(e))
-        logger.error('T3.job_utilities.report_start', 'Dying after 5 attempts!')
-        raise requests.ConnectionError()
+        _report('/condor/start', payload)
 
 
 # write a lock file, based on what succeeded, 
@@ -357,24 +668,16 @@ def report_done(outdir, outfilename, processed):
         stageout(outdir, outfilename, outfilename)
         cleanup('*.lock')
     else:
-        # this really has to work, so go forever
-        while True:
-            try:
-                payload = {'timestamp' : int(time()), 
-                           'task' : _task_name + '_' + _user, 
-                           'job_id' : _job_id, 
-                           'args' : [cb.md5hash(v) for _, v in processed.iteritems()]}
-                logger.info('T3.job_utilities.report_done', 
-                            'payload=\n%s'%repr(payload))
-                r = requests.post(cb.report_server+'/condor/done', json=payload)
-                if r.status_code == 200:
-                    logger.info('T3.job_utilities.report_done', 'return=%s'%(str(r).strip()))
-                    return 
-                else:
-                    logger.error('T3.job_utilities.report_done', 'return=%s'%(str(r).strip()))
-                sleep(10)
-            except requests.ConnectionError as e:
-                logger.error('T3.job_utilities.report_done', str(e))
+        payload = {'timestamp' : int(time()), 
+                   'task' : _task_name + '_' + _user, 
+                   'job_id' : _job_id, 
+                   'args' : [cb.md5hash(v) for _, v in processed.iteritems()]}
+        logger.info('T3.job_utilities.report_done', 
+                    'payload=\n%s'%repr(payload))
+        _report('/condor/done', payload)
+        # this really has to work, so give it time to go through. whatever is
+        # left stays in the journal and is resent by the next job on the node
+        flush_reports(300)
 
 
 # make a record in the primary output of what
@@ -475,27 +778,134 @@ def run_PandaAnalyzer(skimmer, isData, output_name):
 def run_HRAnalyzer(*args, **kwargs):
     return run_Analyzer(*args, **kwargs) 
 
+# run fn on a single staged input
+def _analyze(to_run, processed, fn, f, input_name):
+    global _stopwatch
+    if input_name:
+        logger.info(_sname+'.main',
+                    'Starting to process '+input_name)
+        success = fn(input_name, (to_run.dtype!='MC'), f)
+        now_ = time()
+        nbytes, events = _n_bytes(input_name), _n_events(input_name)
+        _stopwatch += time() - now_ # don't count the bookkeeping
+        print_time('analyze', input_name, nbytes, events)
+        if success:
+            processed[input_name] = f
+        if input_name[:5] == 'input': # if this is a local copy
+            cleanup(input_name)
+        print_time('remove', input_name)
+
+
+# stage in and analyze one file in its own subdirectory.
+# runs in a child process, so a crash only loses this file
+def _run_isolated(to_run, fn, i_file, results):
+    global _stopwatch
+    _stopwatch = time()
+    wd = 'file_%i'%i_file
+    os.mkdir(wd)
+    os.chdir(wd)
+    # fn expects to find whatever pre_fn left in the job directory. files get
+    # private copies, so that writing to one cannot clobber another child's.
+    # only directories (the release area) and large files are shared
+    from_job_dir = set([])
+    for x in os.listdir('..'):
+        if x.startswith('file_') or x.startswith('output_'): # other children
+            continue
+        src = path.abspath('../'+x)
+        if path.isdir(src):
+            os.symlink(src, x)
+        elif not path.isfile(src):
+            continue
+        elif path.getsize(src) > _max_private:
+            os.link(src, x)
+        else:
+            shutil.copy2(src, x)
+        from_job_dir.add(x)
+    processed = {}
+    f = to_run.files[i_file]
+    input_name = stage_in(f)
+    print_time('copy', input_name, _n_bytes(input_name))
+    _analyze(to_run, processed, fn, f, input_name)
+    # leave the outputs where hadd expects them
+    for out in os.listdir('.'):
+        if out in from_job_dir:
+            os.remove(out)
+        else:
+            shutil.move(out, '../'+out)
+    os.chdir('..')
+    cleanup(wd)
+    if _input_cache is not None:
+        _input_cache.report()
+    flush_reports(60)
+    results.put((i_file, processed))
+
+
+# number of cores the slot was given
+def _slot_cpus():
+    try:
+        with open(getenv('_CONDOR_JOB_AD', '')) as fad:
+            for l in fad:
+                if l.startswith('RequestCpus'):
+                    return int(l.split('=')[1])
+    except (IOError, ValueError):
+        pass
+    # condor also sets this to the slot size
+    return int(getenv('OMP_NUM_THREADS', mp.cpu_count()))
+
+
+# run fn on up to nproc files at a time
+def _main_parallel(to_run, processed, fn, nproc):
+    results = mp.Queue()
+    pending = range(len(to_run.files))
+    running = {}
+    while pending or running:
+        while pending and len(running) < nproc:
+            i_file = pending.pop(0)
+            p = mp.Process(target=_run_isolated, args=(to_run, fn, i_file, results))
+            p.start()
+            running[i_file] = p
+        try:
+            i_file, processed_ = results.get(timeout=10)
+            processed.update(processed_)
+            running.pop(i_file).join()
+        except Empty:
+            # a clean exit always delivers its result, so only crashes are lost
+            for i_file, p in running.items():
+                if not p.is_alive() and p.exitcode != 0:
+                    logger.error(_sname+'.main', 
+                                 'Processing %s exited with code %i'%(to_run.files[i_file], 
+                                                                      p.exitcode))
+                    del running[i_file]
+    print_time('analyze %i files with %i processes'%(len(to_run.files), nproc))
+
+
 # main function to run a skimmer, customizable info 
 # can be put in fn
-def main(to_run, processed, fn):
+def main(to_run, processed, fn, nproc=None):
+    global _sample
+    _sample = sub('_[0-9]+$', '', to_run.name)
     print_time('loading')
-    for f in to_run.files:
-        for i_attempt in xrange(maxcopy):
-            input_name = request_data(f, i_attempt==0)
-            if input_name is not None:
-                break
-            sleep(30)
-        print_time('copy %s'%input_name)
-        if input_name:
-            logger.info(_sname+'.main',
-                        'Starting to process '+input_name)
-            success = fn(input_name, (to_run.dtype!='MC'), f)
-            print_time('analyze %s'%input_name)
-            if success:
-                processed[input_name] = f
-            if input_name[:5] == 'input': # if this is a local copy
-                cleanup(input_name)
-            print_time('remove %s'%input_name)
+    nproc = nproc or _nproc
+    if nproc > 1 and nproc > _slot_cpus():
+        logger.warning(_sname+'.main', 'Asked for %i processes, the slot has %i cores'%(nproc, 
+                                                                                         _slot_cpus()))
+        nproc = _slot_cpus()
+    if nproc > 1:
+        _main_parallel(to_run, processed, fn, nproc)
+    elif _prefetch_depth > 0:
+        prefetcher = Prefetcher(to_run.files)
+        for f, input_name, size in prefetcher:
+            print_time('wait for data', input_name, _n_bytes(input_name))
+            _analyze(to_run, processed, fn, f, input_name)
+            prefetcher.release(size)
+        prefetcher.join()
+    else:
+        for f in to_run.files:
+            input_name = stage_in(f)
+            print_time('copy', input_name, _n_bytes(input_name))
+            _analyze(to_run, processed, fn, f, input_name)
+        if _input_cache is not None:
+            _input_cache.report()
     
     if len(processed)==0:
         logger.warning(_sname+'.main', 'No successful outputs!')
@@ -503,7 +913,8 @@ def main(to_run, processed, fn):
 
 
 
-def wrapper(fn, pre_fn=None, post_fn=None):
+def wrapper(fn, pre_fn=None, post_fn=None, nproc=None, 
+            to_drop=None, to_keep=None, record=False):
     which = int(argv[1])
     submit_id = int(argv[2])
 
@@ -529,19 +940,30 @@ def wrapper(fn, pre_fn=None, post_fn=None):
         pre_fn()
         print_time('pre_fn')
 
-    main(to_run, processed, fn)
+    main(to_run, processed, fn, nproc)
     
-    hadd(processed.keys())
+    # branches can only be dropped while merging if nothing runs afterwards
+    single_pass = post_fn is None
+    ret = merge_outputs(processed.keys(), 
+                        to_drop=(to_drop if single_pass else None), 
+                        to_keep=(to_keep if single_pass else None), 
+                        processed=(processed if record else None))
     print_time('hadd')
+    if ret:
+        exit(2)
 
     if post_fn is not None:
         post_fn()
         print_time('post_fn')
+        if drop_branches(to_drop, to_keep):
+            exit(2)
+        print_time('drop branches')
 
+    nbytes = _n_bytes('output.root')
     ret = stageout(outdir,outfilename)
     cleanup('*.root')
     un_isolate(wd)
-    print_time('stageout and cleanup')
+    print_time('stageout and cleanup', nbytes=nbytes)
     if not ret:
         report_done(lockdir,outfilename,processed)
         cleanup('*.lock')
@@ -0,0 +1,226 @@
+'''PandaAnalysis.T3.reporting
+
+Non-blocking client for the job report server
+'''
+
+import json
+import fcntl
+import atexit
+import requests
+import threading
+from glob import glob
+from os import path, getpid, makedirs, remove, stat, fstat, close
+from random import uniform
+from socket import gethostname
+from tempfile import mkstemp
+from time import time, sleep
+
+from PandaCore.Utils.logging import logger
+
+_sname = 'T3.reporting'
+
+
+class Reporter(object):
+    def __init__(self, server, journal_dir, batched=('/condor/requestdata',),
+                 max_batch=100, max_backoff=300, batch_retry=600):
+        '''
+        Arguments:
+            server {str} -- base URL of the report server
+            journal_dir {str} -- directory of journals, one per process, of reports and
+                                 acknowledgements. it should outlive the job (e.g. node-local
+                                 /tmp, not the condor scratch directory), so that whatever a
+                                 job could not deliver is resent by the next Reporter on the node
+            batched {tuple} -- endpoints whose payloads can be sent as a list
+            max_batch {int} -- maximum number of payloads per batched POST
+            max_backoff {float} -- upper bound on the delay between retries, in s
+            batch_retry {float} -- if the server refuses a list, send one payload
+                                   per request for this long, in s, then try lists again
+        '''
+        self.server = server
+        self.journal_dir = path.abspath(journal_dir)
+        self.batched = set(batched)
+        self.max_batch = max_batch
+        self.max_backoff = max_backoff
+        self.batch_retry = batch_retry
+        self._pid = None
+        self._fjournal = None
+        self._start()
+        self._replay()
+        atexit.register(self._close)
+
+    # (re)initialize the per-process state. every process, including forked
+    # children, writes its own journal, locked for as long as the process lives
+    def _start(self):
+        if self._fjournal is not None:
+            # the parent's journal and its lock stay with the parent
+            self._fjournal.close()
+        self._pid = getpid()
+        try:
+            if not path.isdir(self.journal_dir):
+                makedirs(self.journal_dir)
+        except OSError: # someone else made it
+            pass
+        fd, self._journal_path = mkstemp(prefix='%s.%i.'%(gethostname(), self._pid),
+                                         suffix='.journal', dir=self.journal_dir)
+        close(fd)
+        self._fjournal = open(self._journal_path, 'a')
+        fcntl.flock(self._fjournal, fcntl.LOCK_EX)
+        self._session = requests.Session()
+        self._cv = threading.Condition()
+        self._pending = []
+        self._seq = 0
+        self._batch_after = 0 # when to try sending lists again
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_fork(self):
+        if self._pid != getpid():
+            self._start()
+
+    def _write(self, record):
+        self._fjournal.write(json.dumps(record) + '\n')
+        self._fjournal.flush()
+
+    # nothing left to deliver, so the journal can start over
+    def _compact(self):
+        self._fjournal.seek(0)
+        self._fjournal.truncate()
+
+    def _close(self):
+        if self._pid != getpid():
+            return
+        with self._cv:
+            if not self._pending:
+                self._fjournal.close()
+                try:
+                    remove(self._journal_path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _read(fjournal):
+        entries = {}
+        for l in fjournal:
+            try:
+                record = json.loads(l)
+            except ValueError: # partially written line
+                continue
+            if 'ack' in record:
+                entries.pop(record['ack'], None)
+            else:
+                entries[record['seq']] = record
+        return [entries[k] for k in sorted(entries)]
+
+    # take over the journals of processes that have exited, and resend what
+    # they never delivered. a journal whose lock can be taken has no owner left
+    def _replay(self):
+        records = []
+        for jpath in glob(path.join(self.journal_dir, '*.journal')):
+            if jpath == self._journal_path:
+                continue
+            try:
+                fjournal = open(jpath)
+            except IOError: # taken over by someone else already
+                continue
+            with fjournal:
+                try:
+                    fcntl.flock(fjournal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError: # its process is alive
+                    continue
+                try:
+                    if stat(jpath).st_ino != fstat(fjournal.fileno()).st_ino:
+                        continue
+                except OSError: # removed while we waited for it
+                    continue
+                records += self._read(fjournal)
+                remove(jpath)
+        if not records:
+            return
+        logger.info(_sname+'.replay', 'Resending %i journaled reports'%len(records))
+        for record in records:
+            self.post(record['endpoint'], record['payload'])
+
+    def post(self, endpoint, payload):
+        self._check_fork()
+        with self._cv:
+            self._seq += 1
+            record = {'seq' : self._seq, 'endpoint' : endpoint, 'payload' : payload}
+            self._write(record)
+            self._pending.append(record)
+            self._cv.notify()
+
+    def _next_batch(self):
+        first = self._pending[0]
+        if time() < self._batch_after or first['endpoint'] not in self.batched:
+            return [first]
+        return [x for x in self._pending
+                if x['endpoint'] == first['endpoint']][:self.max_batch]
+
+    def _send(self, batch):
+        endpoint = batch[0]['endpoint']
+        if len(batch) > 1:
+            payload = [x['payload'] for x in batch]
+        else:
+            payload = batch[0]['payload']
+        try:
+            r = self._session.post(self.server+endpoint, json=payload, timeout=60)
+        except requests.RequestException as e:
+            logger.warning(_sname+'.send', str(e))
+            return False
+        if r.status_code == 200:
+            logger.info(_sname+'.send', '%s x%i return=%s'%(endpoint, len(batch),
+                                                            str(r).strip()))
+            return True
+        logger.warning(_sname+'.send', '%s x%i return=%s'%(endpoint, len(batch),
+                                                           str(r).strip()))
+        if len(batch) > 1:
+            # server does not take lists, fall back to one payload per request for a while
+            self._batch_after = time() + self.batch_retry
+        return False
+
+    def _backoff(self, n_failures):
+        return min(self.max_backoff, 2 ** n_failures) * uniform(0.5, 1)
+
+    def _run(self):
+        n_failures = 0
+        while True:
+            with self._cv:
+                while not self._pending:
+                    self._cv.wait()
+                batch = self._next_batch()
+            if self._send(batch):
+                n_failures = 0
+                with self._cv:
+                    for record in batch:
+                        self._pending.remove(record)
+                        self._write({'ack' : record['seq']})
+                    if not self._pending:
+                        self._compact()
+                    self._cv.notify_all()
+            elif len(batch) == 1:
+                n_failures += 1
+                sleep(self._backoff(n_failures))
+
+    def flush(self, timeout=None):
+        '''
+        Block until everything has been delivered, or until timeout (in s) has passed
+
+        Returns:
+            True if nothing is left to send
+        '''
+        self._check_fork()
+        start = time()
+        with self._cv:
+            while self._pending:
+                if timeout is not None:
+                    remaining = timeout - (time() - start)
+                    if remaining <= 0:
+                        break
+                    self._cv.wait(remaining)
+                else:
+                    self._cv.wait(60)
+            n_left = len(self._pending)
+        if n_left:
+            logger.warning(_sname+'.flush', '%i reports not yet delivered'%n_left)
+        return n_left == 0
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+'''
+Exercises CachedSchedd from T3/bin/condor_status.py against a stand-in schedd:
+ - per-cluster queries are answered from one query for all clusters of the task
+ - a cluster is only marked finished once two separate queries saw it empty,
+   so a single empty answer from the schedd does not lose a running cluster
+ - finished clusters are not queried any more
+'''
+
+import sys
+from os import path
+from re import findall
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'bin'))
+from condor_status import CachedSchedd
+
+class FakeSchedd(object):
+    def __init__(self, jobs):
+        self.jobs = jobs      # cluster_id -> number of jobs in the queue
+        self.hiccups = set()  # clusters the next query does not see
+        self.queries = []
+    def query(self, constraint, attr_list):
+        clusters = [int(x) for x in findall(r'ClusterId =\?= ([0-9]+)', constraint)]
+        self.queries.append(clusters)
+        answer = []
+        for cluster_id in clusters:
+            if cluster_id in self.hiccups:
+                continue
+            answer += [{'ClusterId' : cluster_id, 'ProcId' : i, 'JobStatus' : 2}
+                       for i in xrange(self.jobs.get(cluster_id, 0))]
+        self.hiccups = set()
+        return answer
+
+def refresh(schedd, clusters):
+    # what TaskStatus.query does: one query per submission, then bookkeeping
+    schedd.invalidate()
+    n = {}
+    for cluster_id in clusters:
+        if cluster_id not in schedd.finished:
+            n[cluster_id] = len(schedd.query('Owner =?= "me" && ClusterId =?= %i'%cluster_id,
+                                             ['ProcId', 'JobStatus']))
+    schedd.update_finished()
+    return n
+
+fake = FakeSchedd({1 : 3, 2 : 0, 3 : 2})
+schedd = CachedSchedd(fake, ttl=3600)
+schedd.cluster_ids.update([1, 2, 3])
+
+n = refresh(schedd, [1, 2, 3])
+assert n == {1 : 3, 2 : 0, 3 : 2}, n
+assert len(fake.queries) == 1 and sorted(fake.queries[0]) == [1, 2, 3], fake.queries
+assert not schedd.finished, 'one empty answer is not enough: %s'%schedd.finished
+
+# cluster 3 is still running, but the schedd misses it once
+fake.hiccups = set([3])
+n = refresh(schedd, [1, 2, 3])
+assert n[3] == 0
+assert schedd.finished == set([2]), schedd.finished
+
+n = refresh(schedd, [1, 2, 3])
+assert n == {1 : 3, 3 : 2}, n
+assert schedd.finished == set([2]), schedd.finished
+assert 2 not in fake.queries[-1], fake.queries[-1]
+
+# cluster 1 leaves the queue for good
+fake.jobs[1] = 0
+refresh(schedd, [1, 2, 3])
+refresh(schedd, [1, 2, 3])
+assert schedd.finished == set([1, 2]), schedd.finished
+
+print 'OK: %i schedd queries for %i refreshes'%(len(fake.queries), 5)
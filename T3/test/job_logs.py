@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+'''
+Exercises the crash bookkeeping of T3/bin/job_logs.py and T3/bin/packing.py:
+ - a job killed while staging in the next file does not blame the file it
+   has just analyzed, even after several such kills
+ - a job killed while analyzing a file blames that file
+ - logs of jobs that are still running are not counted as crashes
+'''
+
+import sys
+import tempfile
+from os import path
+from shutil import rmtree
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'bin'))
+import job_logs
+import packing
+
+base = 'root://xrootd.cmsaf.mit.edu//store/user/paus/pandaf/x_%i.root'
+
+def write_log(logdir, name, lines):
+    with open(path.join(logdir, name + '.err'), 'w') as flog:
+        flog.write('hostname = t3btch000.mit.edu\n')
+        for l in lines:
+            flog.write(l + '\n')
+
+def request(i):
+    return 'INFO T3.job_utilities.request_data %s'%(base%i)
+
+def timing(label, i):
+    return 'INFO T3.job_utilities.print_time: 1.0 s elapsed performing "%s input_%i.root"'%(label, i)
+
+logdir = tempfile.mkdtemp()
+# analyzed file 1, then killed while copying file 2, twice
+for name in ['killed_stagein_a', 'killed_stagein_b']:
+    write_log(logdir, name, [request(1), timing('copy', 1), timing('analyze', 1),
+                             timing('remove', 1), request(2)])
+# killed while analyzing file 3
+write_log(logdir, 'killed_analysis', [request(3), timing('copy', 3)])
+# file 4 is being analyzed right now
+write_log(logdir, 'running', [request(4), timing('copy', 4)])
+
+logs = dict([(log.name, log) for log in job_logs.parse_all(logdir)])
+assert logs['killed_stagein_a'].crashed() is None, logs['killed_stagein_a'].crashed()
+assert logs['killed_analysis'].crashed() == base%3, logs['killed_analysis'].crashed()
+
+# file 1 is healthy, so plan_resubmission will not isolate it
+history = packing.history(logdir, [base%4])
+assert history.crashes == {base%3 : 1}, history.crashes
+assert base%1 in history.seconds
+
+# once the job of file 4 is gone without finishing, it is a crash
+history = packing.history(logdir)
+assert history.crashes == {base%3 : 1, base%4 : 1}, history.crashes
+
+rmtree(logdir)
+print 'OK: %i logs, crashes %s'%(len(logs), sorted(history.crashes.values()))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+'''
+Exercises T3/python/reporting.py against a local stand-in for the report server:
+ - the server is down at first, then refuses lists, then takes everything
+ - a journal left behind by a dead process is resent, exactly once
+ - nothing is lost or sent twice, and the journals are cleaned up
+'''
+
+import json
+import threading
+import tempfile
+from glob import glob
+from os import path
+from shutil import rmtree
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from PandaAnalysis.T3.reporting import Reporter
+
+received = []   # (endpoint, payload)
+state = {'down' : 3, 'lists' : False}
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if state['down'] > 0:
+            state['down'] -= 1
+            self.send_response(503)
+        elif type(payload) == list and not state['lists']:
+            state['lists'] = True # take lists from now on
+            self.send_response(400)
+        else:
+            for p in (payload if type(payload) == list else [payload]):
+                received.append((self.path, p))
+            self.send_response(200)
+        self.end_headers()
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(('localhost', 0), Handler)
+t = threading.Thread(target=server.serve_forever)
+t.daemon = True
+t.start()
+url = 'http://localhost:%i'%server.server_address[1]
+
+journal_dir = tempfile.mkdtemp()
+# a journal of a job that died with one report acked and one not
+with open(path.join(journal_dir, 'deadhost.1.x.journal'), 'w') as fdead:
+    fdead.write(json.dumps({'seq' : 1, 'endpoint' : '/condor/start', 'payload' : {'job' : 'dead'}}) + '\n')
+    fdead.write(json.dumps({'seq' : 2, 'endpoint' : '/condor/done', 'payload' : {'job' : 'dead'}}) + '\n')
+    fdead.write(json.dumps({'ack' : 1}) + '\n')
+    fdead.write('{"seq" : 3, "endpo') # killed while writing
+
+reporter = Reporter(url, journal_dir, max_backoff=0.1, batch_retry=0)
+for i in xrange(20):
+    reporter.post('/condor/requestdata', {'i' : i})
+reporter.post('/condor/done', {'job' : 'alive'})
+assert reporter.flush(30), 'reports were not delivered'
+
+# a second reporter on the node finds nothing left to resend
+Reporter(url, journal_dir).flush(5)
+
+payloads = sorted([json.dumps(x, sort_keys=True) for x in received])
+expected = sorted([json.dumps(x, sort_keys=True) for x in
+                   [('/condor/done', {'job' : 'dead'}), ('/condor/done', {'job' : 'alive'})] +
+                   [('/condor/requestdata', {'i' : i}) for i in xrange(20)]])
+assert payloads == expected, 'expected\n%s\ngot\n%s'%(expected, payloads)
+assert not path.isfile(path.join(journal_dir, 'deadhost.1.x.journal'))
+assert all([path.getsize(j) == 0 for j in glob(path.join(journal_dir, '*.journal'))])
+
+server.shutdown()
+rmtree(journal_dir)
+print 'OK: %i reports delivered exactly once'%len(received)